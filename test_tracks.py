@@ -0,0 +1,159 @@
+"""
+Checks that the tracking gives the same results as the original script, that every tracking mode gives the same results
+as makeTrajectories, and that binary event files hold the same events as the text file. Run with python test_tracks.py from this directory.
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+import tracks_standalone as ts
+
+dataFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "niffte_data.txt")
+
+#sha1 of every niffte_data.txt event as the original script left it after the clean stage, with the default thresholds.
+#Each event adds the json of ([[spine, flesh] for each trajectory], orphans), every voxel given by its 4 ids, all in order.
+originalDigest = "82b608d2ef67ed2ecea30bd83d78b343c956a7ba"
+
+def trackingDigest(events):
+    h = hashlib.sha1()
+    for ev in events:
+        d = ev.getData()
+        ids = lambda li: [[int(x) for x in d[i, :4]] for i in li]
+        h.update(json.dumps(([[ids(t.getSpine()), ids(t.getFlesh())] for t in ev.getTrajectories()], ids(ev.getOrphans()))))
+    return h.hexdigest()
+
+def randomEvent(eventid, rng):
+    """
+    A blob of random voxels in a small box, so clusters touch and split in many ways. Some voxels are repeated with another adc.
+    """
+    box = rng.randint(3, 12)
+    n = min(rng.randint(5, 400), (box + 1)**3)
+    points = set()
+    while len(points) < n:
+        points.add((rng.randint(0, 1), rng.randint(0, box), rng.randint(0, box), rng.randint(0, box)))
+    top = rng.choice([3, 10, 60])
+    rows = [list(p) + [rng.randint(1, top)] for p in sorted(points)]
+    rows.extend([rows[rng.randrange(len(rows))][:4] + [rng.randint(1, top)] for k in range(rng.choice([0, 0, 3]))])
+    rng.shuffle(rows)
+    ev = ts.Event(eventid)
+    ev.setData(np.array(rows, dtype=int))
+    return ev
+
+def copyEvent(ev):
+    cp = ts.Event(ev.getID())
+    cp.setData(ev.getData().copy())
+    return cp
+
+def trackingResult(ev, params, **mode):
+    ev = copyEvent(ev)
+    res = ts.processEvent(ev, *params, **mode)
+    return ev.getAssignment(), res.merged, res.pruned
+
+def windowedResult(ev, params, window, numworkers):
+    gradthresh, dirthresh, mergethresh, prunethresh = params
+    ev = copyEvent(ev)
+    startlen = ev.numVoxels()
+    ev.trackWindowed(gradthresh, dirthresh, window, numworkers=numworkers)
+    merged = ev.mergeTrajectories(mergethresh)
+    pruned = ev.cleanTrajectories(startlen * prunethresh)
+    return ev.getAssignment(), merged, pruned
+
+
+class OriginalResultsTest(unittest.TestCase):
+
+    def testSampleFile(self):
+        events = []
+        for ev in ts.readEvents(dataFile):
+            ts.processEvent(ev, .75, 2.05, .75, .08)
+            events.append(ev)
+        self.assertEqual(sum([ev.numVoxels() for ev in events]), 18033)
+        self.assertEqual(sum([len(ev.getTrajectories()) for ev in events]), 240)
+        self.assertEqual(sum([len(ev.getOrphans()) for ev in events]), 2645)
+        self.assertEqual(trackingDigest(events), originalDigest)
+
+
+class TrackingModesTest(unittest.TestCase):
+    """
+    Segmenting and windows have to give what makeTrajectories gives, trajectory for trajectory and orphan for orphan.
+    """
+
+    def assertSameResult(self, expected, result, what):
+        a, merged, pruned = expected
+        b, bmerged, bpruned = result
+        for k in sorted(a):
+            self.assertTrue(np.array_equal(a[k], b[k]), what + " differs in " + k)
+        self.assertEqual((merged, pruned), (bmerged, bpruned), what + " merged or pruned a different number")
+
+    def checkModes(self, ev, params):
+        expected = trackingResult(ev, params)
+        self.assertSameResult(expected, trackingResult(ev, params, segment=True), "event %d segmented" % ev.getID())
+        for window in (1, 3, 8, 64):
+            self.assertSameResult(expected, trackingResult(ev, params, window=window), "event %d in windows of %d" % (ev.getID(), window))
+
+    def testSampleFile(self):
+        for ev in ts.readEvents(dataFile):
+            self.checkModes(ev, (.75, 2.05, .75, .08))
+
+    def testRandomEvents(self):
+        rng = random.Random(1)
+        for n in range(300):
+            params = (rng.choice([.75, .5, 1.5]), rng.choice([2.05, 1., 5.]), rng.choice([.75, .3, 2.]), .08)
+            self.checkModes(randomEvent(n, rng), params)
+
+    def testWindowWorkers(self):
+        params = (.75, 2.05, .75, .08)
+        for ev in list(ts.readEvents(dataFile))[::10]:
+            expected = trackingResult(ev, params)
+            for window in (1, 8):
+                self.assertSameResult(expected, windowedResult(ev, params, window, 2), "event %d in windows of %d on 2 workers" % (ev.getID(), window))
+
+    def testNarrowWindow(self):
+        ev = ts.readEvents(dataFile).next()
+        self.assertRaises(ValueError, ev.trackWindowed, .75, 2.05, 0)
+
+
+class BinaryEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.binfile = os.path.join(self.dir, "niffte_data.bin")
+        ts.convertToBinary(dataFile, self.binfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runOutput(self, args):
+        out = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            ts.main(args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = out
+
+    def testRoundTrip(self):
+        self.assertTrue(ts.checkBinaryFile(dataFile, self.binfile))
+        binevents = ts.BinaryEvents(self.binfile)
+        self.assertEqual(len(binevents), 100)
+        text = dict([(ev.getID(), ev) for ev in ts.readEvents(dataFile)])
+        for n in (12, 28, 70):
+            ev = binevents.getEvent(n)
+            self.assertEqual(ev.getID(), n)
+            self.assertTrue(np.array_equal(ev.getData(), text[n].getData()))
+
+    def testPickedEvents(self):
+        expected = self.runOutput(["--no-plots", dataFile, "--events", "12,28,70"])
+        self.assertTrue("Event 70" in expected)
+        self.assertEqual(self.runOutput(["--no-plots", self.binfile, "--events", "12,28,70"]), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,26 @@
+import argparse
+import collections
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import Queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    #no file locks, ResultCache eviction runs unlocked
+    fcntl = None
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+
+#Set on import, for measuring the time to the first event
+importTime = time.time()
 
 #John Van Atta
 #12 June 2013
@@ -31,53 +51,554 @@ class Voxel(object):
         return str(self.id) + "  " + str(self.adc)
 
 
+class IndexBuffer(object):
+    """
+    A growable array of voxel indices into an event's store. Appending is amortized constant time.
+    view() returns the filled part without copying.
+    """
+    
+    def __init__(self, size=8):
+        self.data = np.empty(size, dtype=np.intp)
+        self.n = 0
+    
+    def __len__(self):
+        return self.n
+    
+    def __iter__(self):
+        return iter(self.view())
+    
+    def __getitem__(self, k):
+        return self.view()[k]
+    
+    def reserve(self, size):
+        if size > len(self.data):
+            grown = np.empty(max(size, 2*len(self.data)), dtype=np.intp)
+            grown[:self.n] = self.data[:self.n]
+            self.data = grown
+    
+    def append(self, i):
+        if self.n == len(self.data):
+            self.reserve(self.n + 1)
+        self.data[self.n] = i
+        self.n += 1
+        
+    def extend(self, li):
+        li = np.asarray(li, dtype=np.intp)
+        self.reserve(self.n + len(li))
+        self.data[self.n:self.n + len(li)] = li
+        self.n += len(li)
+    
+    def view(self):
+        return self.data[:self.n]
+    
+    def remap(self, idx):
+        """
+        Replace every stored index i with idx[i]. Used to move indices from a sub-event back to its parent event.
+        """
+        self.data[:self.n] = idx[self.data[:self.n]]
+
+
+class VoxelGraph(object):
+    """
+    The 20-neighbor hex/time adjacency of an event's voxels, in compressed sparse row form.
+    The neighbors of voxel i are indices[indptr[i]:indptr[i+1]], in the order of the neighbor offset tables.
+    Each edge also stores its offset (row, column, bucket) from voxel i to the neighbor, and dE, voxel i's adc minus the neighbor's.
+    Built once per event by buildGraph, then shared by every tracking run. save() and loadGraph() keep it on disk next to the event data.
+    """
+    
+    def __init__(self, indptr, indices, offsets, dE, duplicates):
+        self.indptr = indptr
+        self.indices = indices
+        self.offsets = offsets
+        self.dE = dE
+        self.duplicates = duplicates
+    
+    def numEdges(self):
+        return len(self.indices)
+    
+    def neighbors(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+    
+    def hasEdge(self, a, b):
+        """
+        True if voxels a and b are neighbors. A voxel has at most 20 edges, so this is constant time.
+        """
+        return b in self.indices[self.indptr[a]:self.indptr[a+1]]
+    
+    def save(self, filename):
+        np.savez(filename, indptr=self.indptr, indices=self.indices, offsets=self.offsets, dE=self.dE, duplicates=self.duplicates)
+
+
 class Event(object):
     """
     Events start with all the voxels for an event. The voxels are processed using makeTrajectories() into Trajectory objects
     The Event class also contains methods to merge multiple trajectories with similar directions and prune small, spurious trajectories    
+    Voxel data is stored in columns: chamber, row, column, bucket, adc. Each column is a contiguous integer array.
+    Trajectories and orphans hold indices into this store, not Voxel objects.
     """
     
     def __init__(self, id):
         self.id = id
-        self.edat = []
+        self.vdat = np.zeros((16, 5), dtype=np.int32, order='F')
+        self.nvox = 0
         self.traj = []
-        self.orphans = []
+        self.orphans = IndexBuffer()
+        self.graph = None
+        #seeds and recycled voxels of every trajectory, only recorded when this is a list. See trackComponents.
+        self.trace = None
+        #counters for the tracking hot paths, only kept when this is an EventStats
+        self.stats = None
+        #hash of the voxel data, see getDigest
+        self.digest = None
+        #seconds spent reading and parsing the event, when timed by timeParsing
+        self.parseTime = 0.
                                        
     def getID(self):
         return self.id
     
     def getData(self):
-        return self.edat
+        """
+        Returns the event's voxels as an (N, 5) array view. Columns are chamber, row, column, bucket, adc.
+        """
+        return self.vdat[:self.nvox]
+    
+    def numVoxels(self):
+        return self.nvox
+    
+    def getDigest(self):
+        """
+        Hex digest of the voxel data in store order. Kept until the voxels change.
+        """
+        if self.digest is None:
+            self.digest = hashlib.sha1(np.ascontiguousarray(self.getData(), dtype='<i4').tostring()).hexdigest()
+        return self.digest
                     
     def getTrajectories(self):
         return self.traj
     
     def getOrphans(self):
-        return self.orphans
-            
+        return self.orphans.view()
+    
+    def getVoxel(self, i):
+        """
+        Build a Voxel object for voxel index i. Meant for printing and testing, tracking works on indices.
+        """
+        return Voxel(self.vdat[i, :4].tolist(), int(self.vdat[i, 4]))
+    
+    def getDirection(self, a, b):
+        """
+        Coordinate differences (du, dv, dw) going from voxel index a to voxel index b, same as getGradient.
+        """
+        d = self.vdat
+        return int(d[a, 1] - d[b, 1]), int(d[a, 2] - d[b, 2]), int(d[a, 3] - d[b, 3])
+    
+    def getAdc(self, i):
+        return int(self.vdat[i, 4])
+    
+    def distance(self, a, b):
+        """
+        voxDistance for two voxel indices in this event.
+        """
+        d = self.vdat
+        if d[a, 0] != d[b, 0]:
+            return 1e10
+        return abs(int(d[a, 1] - d[b, 1])) + abs(int(d[a, 2] - d[b, 2])) + abs(int(d[a, 3] - d[b, 3]))
+    
+    def reset(self):
+        """
+        Forget any trajectories and orphans so the event can be tracked again, for example with different parameters.
+        The voxel store and adjacency graph are kept.
+        """
+        self.traj = []
+        self.orphans = IndexBuffer()
+    
+    def getAssignment(self):
+        """
+        The tracking result as a dict of flat arrays, see ResultCache. Each trajectory's spine, flesh and members are concatenated,
+        with ptr arrays marking where each trajectory starts. state has a row of direction and direction sums per trajectory.
+        """
+        def pack(bufs):
+            ptr = np.zeros(len(bufs) + 1, dtype=np.int64)
+            np.cumsum([len(b) for b in bufs], out=ptr[1:])
+            if len(bufs) == 0:
+                return np.zeros(0, dtype=np.int64), ptr
+            return np.concatenate(bufs).astype(np.int64), ptr
+        
+        spine, spineptr = pack([t.getSpine() for t in self.traj])
+        flesh, fleshptr = pack([t.getFlesh() for t in self.traj])
+        members, memberptr = pack([t.getMembers() for t in self.traj])
+        state = np.array([[t.du, t.dv, t.dw, t.su, t.sv, t.sw, t.weight] for t in self.traj], dtype=float).reshape(-1, 7)
+        return {"spine": spine, "spineptr": spineptr, "flesh": flesh, "fleshptr": fleshptr, "members": members,
+                "memberptr": memberptr, "state": state, "orphans": np.asarray(self.getOrphans(), dtype=np.int64)}
+    
+    def setAssignment(self, a):
+        """
+        Replace the trajectories and orphans with a result from getAssignment, without tracking anything.
+        """
+        self.reset()
+        for k in range(len(a["state"])):
+            spine = a["spine"][a["spineptr"][k]:a["spineptr"][k+1]]
+            t = Trajectory(self, int(spine[0]))
+            t.spine.extend(spine[1:])
+            t.flesh.extend(a["flesh"][a["fleshptr"][k]:a["fleshptr"][k+1]])
+            t.members = IndexBuffer()
+            t.members.extend(a["members"][a["memberptr"][k]:a["memberptr"][k+1]])
+            t.du, t.dv, t.dw, t.su, t.sv, t.sw, t.weight = a["state"][k].tolist()
+            t.tail = int(spine[-1])
+            self.traj.append(t)
+        self.orphans.extend(a["orphans"])
+    
     def printData(self):
-        for v in self.edat:
-            print v.toString()
+        for i in range(self.nvox):
+            print self.getVoxel(i).toString()
     
     def addVoxel(self, d):
-        self.edat.append(Voxel([int(d[0]), int(d[1]), int(d[2]), int(d[3])] , int(d[4])))
+        if self.nvox == len(self.vdat):
+            grown = np.zeros((2*len(self.vdat), 5), dtype=np.int32, order='F')
+            grown[:self.nvox] = self.vdat[:self.nvox]
+            self.vdat = grown
+        self.vdat[self.nvox] = [int(d[0]), int(d[1]), int(d[2]), int(d[3]), int(d[4])]
+        self.nvox += 1
+        self.graph = None
+        self.digest = None
+    
+    def setData(self, arr):
+        """
+        Replace the event's voxels with an (N, 5) integer array in one step. Columns are chamber, row, column, bucket, adc.
+        """
+        self.vdat = np.asfortranarray(arr, dtype=np.int32).reshape(-1, 5)
+        self.nvox = len(self.vdat)
+        self.graph = None
+        self.digest = None
     
 
-    def popNeighbors(self, vox):
+    def buildGraph(self):
+        """
+        Build the event's adjacency graph (see VoxelGraph) and keep it with the event, so repeated tracking runs only build it once.
+        Voxel ids are packed into single integer keys, then every voxel's 20 possible neighbor keys are looked up in the sorted keys
+        at once. The coordinates are padded by one on each side so a neighbor offset can never wrap into another row or chamber.
+        Data read by readEvents has no duplicate ids (see validateVoxels). Should other data have them, only the first one in the store
+        can be a neighbor, and tracking sends the others straight to the orphans.
+        """
+        d = self.getData()
+        n = len(d)
+        coords = d[:, :4].astype(np.int64)
+        if n > 0:
+            coords -= coords.min(axis=0) - 1
+            dims = coords.max(axis=0) + 2
+        else:
+            dims = np.ones(4, dtype=np.int64)
+        strides = np.array([dims[1]*dims[2]*dims[3], dims[2]*dims[3], dims[3], 1])
+        keys = coords.dot(strides)
+        
+        order = np.argsort(keys, kind='mergesort')
+        skeys = keys[order]
+        duplicates = order[1:][skeys[1:] == skeys[:-1]]
+        
+        #neighbor offsets for every voxel, picked by row parity
+        odd = (d[:, 1] % 2 == 1)
+        offs = np.where(odd[:, None, None], np.array(oddRowOffsets)[None], np.array(evenRowOffsets)[None])
+        nkeys = keys[:, None] + offs.dot(strides[1:])
+        pos = np.minimum(np.searchsorted(skeys, nkeys), max(n - 1, 0))
+        hit = (skeys[pos] == nkeys) if n > 0 else np.zeros((0, 20), dtype=bool)
+        
+        counts = hit.sum(axis=1)
+        indptr = np.zeros(n + 1, dtype=np.intp)
+        np.cumsum(counts, out=indptr[1:])
+        indices = order[pos[hit]]
+        rows = np.repeat(np.arange(n), counts)
+        dE = (d[rows, 4] - d[indices, 4]).astype(np.int32)
+        self.graph = VoxelGraph(indptr, indices, offs[hit].astype(np.int8), dE, duplicates)
+        return self.graph
+    
+    def getGraph(self):
+        if self.graph is None:
+            self.buildGraph()
+        return self.graph
+    
+    def setGraph(self, graph):
+        """
+        Attach a graph built earlier, for example one read back with loadGraph.
+        """
+        self.graph = graph
+    
+    def neighborCheck(self, a, b):
+        """
+        Check if voxel indices a and b are neighbors, with a single edge test on the event's graph.
+        """
+        return self.getGraph().hasEdge(a, b)
+    
+    def findComponents(self):
+        """
+        Split the event into connected clusters of neighboring voxels. Trajectories only grow through neighbors, so tracking never
+        crosses from one cluster to another, and different chambers are never neighbors.
+        Every voxel takes the smallest label among its neighbors, then labels are followed to their own label, until nothing changes.
+        That leaves each cluster labeled with its first voxel. Returns component numbers 0, 1, 2... per voxel, in order of each
+        component's first voxel. Duplicate voxels get -1.
+        """
+        g = self.getGraph()
+        labels = np.arange(self.nvox)
+        withedges = np.flatnonzero(np.diff(g.indptr) > 0)
+        starts = g.indptr[withedges]
+        while len(withedges) > 0:
+            new = labels.copy()
+            new[withedges] = np.minimum(new[withedges], np.minimum.reduceat(labels[g.indices], starts))
+            new = new[new]
+            if np.array_equal(new, labels):
+                break
+            labels = new
+        labels[g.duplicates] = -1
+        first, comp = np.unique(labels, return_inverse=True)
+        if len(g.duplicates) > 0:
+            comp -= 1
+        return comp
+    
+    def trackComponents(self, gradthresh, dirthresh, weighting='uniform', decay=.9, mincomponent=2, numworkers=1):
+        """
+        makeTrajectories, run separately on each connected component (see findComponents). With numworkers above 1 the components
+        are spread over a pool of worker processes, 0 uses every core.
+        Components with fewer than mincomponent voxels go straight to the orphans without tracking. A single voxel always ends up an
+        orphan, so the default of 2 gives the same result as makeTrajectories. Larger values skip small noise clusters.
+        
+        The component results are stitched back in the order makeTrajectories would have created the trajectories and orphans,
+        so merging gives the same result too, see stitchComponents.
+        """
+        labels = self.findComponents()
+        jobs = []
+        tracked = []
+        dropped = []
+        for idx in splitComponents(labels):
+            if len(idx) < mincomponent:
+                dropped.append(idx)
+            else:
+                jobs.append((self.getData()[idx], gradthresh, dirthresh, weighting, decay, self.stats is not None))
+                tracked.append(idx)
+        
+        if numworkers is None or numworkers == 0:
+            numworkers = multiprocessing.cpu_count()
+        if numworkers == 1 or len(jobs) < 2:
+            results = map(trackComponentArgs, jobs)
+        else:
+            pool = multiprocessing.Pool(min(numworkers, len(jobs)))
+            try:
+                results = pool.map(trackComponentArgs, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        
+        parts = [self.componentPart(idx, sub, trace) for idx, (sub, trace) in zip(tracked, results)]
+        self.stitchComponents(parts, dropped, self.getGraph().duplicates)
+    
+    def trackWindowed(self, gradthresh, dirthresh, window=64, weighting='uniform', decay=.9, mincomponent=2, numworkers=1):
+        """
+        trackComponents for events too long to graph whole. The event is walked in windows of window buckets. Each window's voxels,
+        together with the clusters still open from the windows before, get their own graph and are split into components.
+        Neighbors are at most one bucket apart, so a component ending two or more buckets before the end of the window cannot grow
+        any further. Those are tracked and their graph and tracking state let go, the rest are carried into the next window.
+        Only a window and its open clusters are ever graphed, so the tracking memory follows the window size and the longest open
+        cluster rather than the event size. A cluster spanning many windows is graphed again in each of them.
+        The result is the same as trackComponents, and with the default mincomponent the same as makeTrajectories.
+        With numworkers above 1, resolved components are tracked in a pool of worker processes while later windows are split.
+        At most 2 components per worker wait in the pool, so the memory bound holds there too.
+        """
+        if window < 1:
+            raise ValueError("Windows have to be at least 1 bucket wide, not " + str(window))
+        d = self.getData()
+        bybucket = np.argsort(d[:, 3], kind='mergesort')
+        buckets = d[bybucket, 3]
+        tracked = []
+        dropped = []
+        duplicates = []
+        
+        def resolved():
+            carried = np.zeros(0, dtype=np.intp)
+            pos = 0
+            while pos < len(bybucket):
+                #skip over empty buckets, unless a carried cluster could still reach the next one
+                lo = buckets[pos] if len(carried) == 0 else max(buckets[pos], hi)
+                hi = lo + window
+                end = np.searchsorted(buckets, hi)
+                cur = np.sort(np.concatenate((carried, bybucket[pos:end])))
+                pos = end
+                part = Event(self.id)
+                part.setData(d[cur])
+                labels = part.findComponents()
+                duplicates.append(cur[labels < 0])
+                part = None
+                
+                carry = []
+                for idx in splitComponents(labels):
+                    idx = cur[idx]
+                    if pos < len(bybucket) and d[idx, 3].max() >= hi - 1:
+                        carry.append(idx)
+                    elif len(idx) < mincomponent:
+                        dropped.append(idx)
+                    else:
+                        tracked.append(idx)
+                        yield d[idx], gradthresh, dirthresh, weighting, decay, self.stats is not None
+                carried = np.concatenate(carry) if carry else np.zeros(0, dtype=np.intp)
+        
+        def throttled():
+            #Pool.imap would split every window up front and queue all of the component copies. Keep at most 2 per worker
+            #in the pool instead and wait for the oldest, so the windows are not split further ahead than the tracking.
+            waiting = collections.deque()
+            for args in resolved():
+                waiting.append(pool.apply_async(trackComponentArgs, (args,)))
+                if len(waiting) >= 2*numworkers:
+                    yield waiting.popleft().get()
+            while waiting:
+                yield waiting.popleft().get()
+        
+        if numworkers is None or numworkers == 0:
+            numworkers = multiprocessing.cpu_count()
+        if numworkers == 1:
+            results = itertools.imap(trackComponentArgs, resolved())
+            pool = None
+        else:
+            pool = multiprocessing.Pool(numworkers)
+            results = throttled()
+        try:
+            parts = [self.componentPart(tracked[k], sub, trace) for k, (sub, trace) in enumerate(results)]
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        
+        #duplicates in the order the whole-event graph lists them, by id and then by place in the store
+        duplicates = np.concatenate(duplicates) if duplicates else np.zeros(0, dtype=np.intp)
+        dd = d[duplicates]
+        duplicates = duplicates[np.lexsort((duplicates, dd[:, 3], dd[:, 2], dd[:, 1], dd[:, 0]))]
+        self.stitchComponents(parts, dropped, duplicates)
+    
+    def componentPart(self, idx, sub, trace):
+        """
+        Move a component tracked by trackComponent back to this event. idx holds the component's voxel indices in this event.
+        Returns (idx, trace, kept) for stitchComponents, kept has the component's trajectories by head.
+        """
+        for t in sub.getTrajectories():
+            t.remap(self, idx)
+        if self.stats is not None:
+            self.stats.addCounts(sub.stats)
+        return idx, trace, dict([(int(t.getHead()), t) for t in sub.getTrajectories()])
+    
+    def stitchComponents(self, parts, dropped, duplicates):
+        """
+        Put separately tracked components back together as trajectories and orphans, in the order makeTrajectories would have made them.
+        parts come from componentPart. dropped holds the voxel indices of untracked components, each voxel counts as a seed of its own.
+        duplicates go to the orphans first, as in indexVoxels.
+        Each component recorded its seeds and the voxels every trajectory recycled. Replaying those with a heap over the components'
+        next seeds gives every recycled voxel the sequence number the whole-event run would have, and so the order the whole-event
+        run would have picked the seeds in. Seeds that did not grow into a trajectory are orphans, added last to first.
+        """
+        self.orphans.extend(duplicates)
+        adc = self.getData()[:, 4]
+        seq = np.arange(self.nvox)
+        seqcount = self.nvox
+        heap = []
+        for c, (idx, trace, kept) in enumerate(parts):
+            if len(trace) > 0:
+                seed = idx[trace[0][0]]
+                heap.append((-adc[seed], seq[seed], c, 0))
+        for idx in dropped:
+            heap.extend([(-adc[v], v, -1, v) for v in idx.tolist()])
+        heapq.heapify(heap)
+        singles = []
+        while heap:
+            negval, s, c, k = heapq.heappop(heap)
+            if c < 0:
+                singles.append(k)
+                continue
+            idx, trace, kept = parts[c]
+            seed, recycled = trace[k]
+            if idx[seed] in kept:
+                self.traj.append(kept[idx[seed]])
+            else:
+                singles.append(idx[seed])
+            for li in recycled:
+                seq[idx[li]] = np.arange(seqcount, seqcount + len(li))
+                seqcount += len(li)
+            if k + 1 < len(trace):
+                nextseed = idx[trace[k+1][0]]
+                heapq.heappush(heap, (-adc[nextseed], seq[nextseed], c, k + 1))
+        self.orphans.extend(singles[::-1])
+    
+    def indexVoxels(self):
         """
-        Locate any neighbors of a given voxel in the event's list.
-        Neighbors are removed from the event's list--make sure they get put somewhere.        
+        Set up the tracking state: which voxels are still free, the seed heap and sequence numbers.
+        Each voxel gets a sequence number, starting from its position in the file, so seeds and neighbors come out
+        in the same order the old sorted list gave them.
         """
-        poplist = []
-        for v in listNeighbors(self.edat, vox):
-            poplist.append(self.edat.pop(self.edat.index(v)))
-        return poplist
+        g = self.graph
+        self.free = np.ones(self.nvox, dtype=bool)
+        self.free[g.duplicates] = False
+        self.orphans.extend(g.duplicates)
+        self.order = np.arange(self.nvox)
+        self.vals = self.getData()[:, 4].tolist()
+        self.seeds = [(-v, i, i) for i, v in enumerate(self.vals)]
+        heapq.heapify(self.seeds)
+        self.seqcount = self.nvox
+        self.mark = 0
     
+    def nextSeed(self):
+        """
+        Take the strongest free voxel to start a trajectory. Returns None once every voxel is used.
+        The seed heap is keyed on (-adc, sequence number), which picks the same voxel as re-sorting the unused voxels by adc would.
+        Entries for voxels that were used, or recycled again since they were pushed, are stale and skipped.
+        """
+        while self.seeds:
+            negval, seq, i = heapq.heappop(self.seeds)
+            if self.free[i] and seq == self.order[i]:
+                self.free[i] = False
+                self.mark = self.seqcount
+                if self.trace is not None:
+                    self.trace.append((i, []))
+                if self.stats is not None:
+                    self.stats.counts["seedPops"] += 1
+                return i
+            if self.stats is not None:
+                self.stats.counts["staleSeeds"] += 1
+        return None
+    
+    def recycleVoxels(self, li):
+        """
+        Free voxels again. They are ordered after everything already free, like appending to the end of the list.
+        """
+        self.free[li] = True
+        self.order[li] = np.arange(self.seqcount, self.seqcount + len(li))
+        if self.trace is not None:
+            self.trace[-1][1].append(li)
+        if self.stats is not None:
+            self.stats.counts["recycled"] += len(li)
+        for i in li.tolist():
+            heapq.heappush(self.seeds, (-self.vals[i], self.seqcount, i))
+            self.seqcount += 1
+
+    def popNeighbors(self, vox):
+        """
+        Locate any free neighbors of a given voxel by walking its edges in the graph and masking out the used voxels.
+        Neighbors are marked as used--make sure they get put somewhere.
+        Returns the neighbor indices and their edge numbers in the graph.
+        """
+        g = self.graph
+        start = g.indptr[vox]
+        nb = g.indices[start:g.indptr[vox+1]]
+        mask = self.free[nb]
+        nb = nb[mask]
+        edges = np.flatnonzero(mask) + start
+        self.free[nb] = False
+        
+        #same order as the old scan through the sorted list. Voxels left over from before this trajectory come first by adc,
+        #highest first, then voxels recycled since it started, in the order they were put back.
+        #dE is this voxel's adc minus the neighbor's, so sorting on it puts the highest adc first.
+        order = self.order[nb]
+        recycled = order >= self.mark
+        srt = np.lexsort((order, np.where(recycled, 0, g.dE[edges]), recycled))
+        return nb[srt], edges[srt]
     
-    def makeTrajectories(self, gradthresh, dirthresh):
+    def makeTrajectories(self, gradthresh, dirthresh, weighting='uniform', decay=.9):
         """
         Convert an event's voxels into one or more trajectories. Takes in two threshold values.
-        First, the voxels are sorted by signal strength. The largest is chosen to start a trajectory.
+        First, the voxels are put in a heap by signal strength. The largest is chosen to start a trajectory.
         Next, its neighbors are found. The neighbor with the smallest gradient (from the current) is added to the spine of the trajectory
         Other neighbors are checked. If they are under thresholds, they are added to the flesh of the trajectory. Checking here creates some orphans,
         it's likely that the code could be improved by only checking for spine members and just adding all their neighbors.
@@ -87,77 +608,74 @@ class Event(object):
         In: gradthresh is a multiplied by the voxel's signal strength as a relative weight.
         dirthresh is an absolute threshold. The direction testing method returns the sum of the squared differences, which are compared
         against dirthresh.
+        weighting and decay pick how trajectories average their spine directions, see Trajectory.
         """
-        #sort based on voxel value
-        self.edat = sorted(self.edat, key = lambda v: v.getVal(), reverse=True)
-        
-        maxlen = len(self.edat)
+        #graph for neighbor lookups, seeds come off a heap based on voxel value
+        temporary = self.graph is None
+        if temporary:
+            self.buildGraph()
+        self.indexVoxels()
+        g = self.graph
+        stats = self.stats
         
         #eventually adds everything to a trajectory        
-        while len(self.edat) > 0:
+        while True:
             
             #start a new trajectory
-            vox = self.edat.pop(0)
-            newTraj = Trajectory(vox)
+            vox = self.nextSeed()
+            if vox is None:
+                break
+            newTraj = Trajectory(self, vox, weighting, decay)
             self.traj.append(newTraj)
             
             #breaks when there are no more candidates being generated
             while True:
                 
-                candidates = []
-                rejects = []
-                chosen = []
-                
                 #add more voxels from the neighbors
-                neigh = self.popNeighbors(vox)
-                candidates.extend(neigh)
-                
-                grad = getGradient(vox, neigh)
+                candidates, edges = self.popNeighbors(vox)
+                if stats is not None:
+                    stats.counts["neighborLookups"] += 1
+                    stats.counts["candidates"] += len(candidates)
+                if len(candidates) == 0:
+                    break
                 
-                #check which voxels satisfying gradient and direction requirements
-                for v in candidates:
-                    thresh = vox.getVal() * gradthresh
-                    if grad[v][1] <= thresh:
-                        if newTraj.checkDir(grad[v][0], dirthresh):
-                            #voxel matches trajectory
-                            chosen.append(v)
-                        else:
-                            rejects.append(v)
-                    else:
-                        rejects.append(v)
+                #check which voxels satisfying gradient and direction requirements, all at once from the edge attributes
+                gradok, dirok, best = candidateKernel(-g.offsets[edges], g.dE[edges], self.vals[vox], gradthresh, newTraj.getDir(), dirthresh)
+                chosen = gradok & dirok
+                if stats is not None:
+                    stats.counts["gradRejects"] += len(gradok) - np.count_nonzero(gradok)
+                    stats.counts["dirRejects"] += np.count_nonzero(gradok) - np.count_nonzero(chosen)
                 
                 #no new chosen, time to break out of the loop
-                if len(chosen) == 0:
-                    self.edat.extend(rejects)
+                if best < 0:
+                    self.recycleVoxels(candidates)
                     break
                 
-                #find the lowest gradient of the neighbors. that will be our new tail
-                mininum = 1000000
-                lowestgrad = None
-                for v in chosen:
-                    if grad[v][1] < mininum:
-                        mininum = grad[v][1]
-                        lowestgrad = v
-                vox = chosen.pop(chosen.index(lowestgrad))
+                #the lowest gradient of the neighbors will be our new tail
+                vox = int(candidates[best])
                 newTraj.addSpine(vox)
                 
                 #add the rest of the voxels that match gradient and direction but are not best
-                for v in chosen:
+                rejects = candidates[~chosen]
+                chosen[best] = False
+                for v in candidates[chosen].tolist():
                     newTraj.addFlesh(v)
                 #recycle unused voxels            
-                self.edat.extend(rejects)
+                self.recycleVoxels(rejects)
             #end of chained tail loop
             
-            #resort
-            self.edat = sorted(self.edat, key = lambda v: v.getVal(), reverse=True)
-            
         #Unpaired voxels end as length 1 trajectories. Destroy these and add the voxels to event's orphans.
         for t in reversed(self.traj):
             if len(t.getSpine()) == 1:
                 self.orphans.extend(t.getMembers())
-                self.traj.remove(t)
+        self.traj = [t for t in self.traj if len(t.getSpine()) > 1]
         
-    def mergeTrajectories(self, mergethresh):
+        #tracking state isn't needed anymore. Unless the graph was built ahead of time, only the columns are kept.
+        del self.free, self.order, self.vals, self.seeds
+        if temporary:
+            self.graph = None
+        
+    def mergeTrajectories(self, mergethresh, maxdist=10):
         """
         Combine multiple trajectories with similar directions and near-matching endpoints into one trajectory.
         Checks each trajectory against all the other trajectories in an event
@@ -170,35 +688,88 @@ class Event(object):
         where two true trajectories with similar directions and translated-but-close endpoints are incorrectly merged. This sort of occurence does
         not appear to be common in the data.
         
+        Trajectories wait in a queue. Each one popped off the front is merged into the first trajectory in queue order that passes both tests,
+        otherwise it goes to the back. Only trajectories with an endpoint in the grid cells around its head and tail are tested. Cells are
+        maxdist wide, so anything closer than maxdist is in a neighboring cell. Merged trajectories are joined in a union-find forest instead
+        of rewriting the endpoint grid: a merged trajectory's tail is still filed under its old owner, and its root is the trajectory it went into.
+        
         In: mergethresh is an absolute parameter similar to dirthresh in makeTrajectories.
+        maxdist is the largest endpoint separation (voxDistance) allowed, exclusive.
         """
         counter = 0
+        trajs = self.traj
+        
+        #union-find parents, and each trajectory's place in the queue
+        parent = range(len(trajs))
+        ticket = range(len(trajs))
+        nextticket = len(trajs)
+        
+        def find(k):
+            while parent[k] != k:
+                parent[k] = parent[parent[k]]
+                k = parent[k]
+            return k
+        
+        #every head and tail, filed by grid cell
+        cells = dict()
+        for k, t in enumerate(trajs):
+            for v in (t.getHead(), t.getTail()):
+                cells.setdefault(self.mergeCell(v, maxdist), []).append((k, v))
+        
+        queue = collections.deque(range(len(trajs)))
+        stats = self.stats
         
         #breaks after no merge activity has occured
         loop = True
         while loop:
             loop = False
-            numtraj = len(self.traj)
-            #for every trajectory, compare against all other trajectories in event
+            numtraj = len(queue)
+            if stats is not None:
+                stats.counts["mergePasses"] += 1
+            #for every trajectory, compare against the trajectories with endpoints nearby
             for x in range(numtraj):
-                t2 = self.traj.pop(0)
+                k2 = queue.popleft()
+                t2 = trajs[k2]
                 tdir = t2.getDir()
+                
+                candidates = set()
+                for end in (t2.getHead(), t2.getTail()):
+                    c, r, col, b = self.mergeCell(end, maxdist)
+                    for key in itertools.product((c,), (r-1, r, r+1), (col-1, col, col+1), (b-1, b, b+1)):
+                        for k, v in cells.get(key, ()):
+                            root = find(k)
+                            #entries for voxels that stopped being an endpoint after a merge are stale
+                            if root != k2 and (v == trajs[root].getHead() or v == trajs[root].getTail()):
+                                candidates.add(root)
+                
                 merged = False
-                for i in range(numtraj):
-                    if i >= len(self.traj):
-                        break
-                    t = self.traj[i]
+                for k in sorted(candidates, key = ticket.__getitem__):
+                    t = trajs[k]
+                    if stats is not None:
+                        stats.counts["mergeComparisons"] += 1
                     #check the unsigned direction agains the threshold, AND check if either trajectory's head or tail are closely located
-                    if t.checkDirReversible(tdir, mergethresh) and (voxDistance(t.getHead(), t2.getHead()) < 10 or voxDistance(t.getTail(), t2.getHead()) < 10 or voxDistance(t.getHead(), t2.getTail()) < 10 or voxDistance(t.getTail(), t2.getTail()) < 10):
+                    if t.checkDirReversible(tdir, mergethresh) and (self.distance(t.getHead(), t2.getHead()) < maxdist or self.distance(t.getTail(), t2.getHead()) < maxdist or self.distance(t.getHead(), t2.getTail()) < maxdist or self.distance(t.getTail(), t2.getTail()) < maxdist):
                             
                         t.merge(t2)
+                        parent[k2] = k
                         merged = True
                         loop = True
                         counter += 1
                         break
                 if not merged:
-                    self.traj.append(t2)
+                    ticket[k2] = nextticket
+                    nextticket += 1
+                    queue.append(k2)
+        
+        self.traj = [trajs[k] for k in queue]
         return counter
+    
+    def mergeCell(self, v, size):
+        """
+        Grid cell key of voxel index v for the endpoint grid in mergeTrajectories. Chambers never share a cell.
+        """
+        d = self.vdat
+        return int(d[v, 0]), int(d[v, 1]) // size, int(d[v, 2]) // size, int(d[v, 3]) // size
         
     def cleanTrajectories(self, cleanthresh):
         """
@@ -207,50 +778,115 @@ class Event(object):
         counter = 0
         for t in reversed(self.traj):
             if len(t.getMembers()) <= cleanthresh:
-                self.orphans.extend(t.getMembers())
-                self.traj.remove(t)
+                #flesh first, then spine, as the orphans always came out
+                self.orphans.extend(t.getFlesh())
+                self.orphans.extend(t.getSpine())
                 counter += 1
+        self.traj = [t for t in self.traj if len(t.getMembers()) > cleanthresh]
         return counter
 
 
 class Trajectory(object):
     """
-    Trajectories hold processed voxels in a list. Voxels are broken into two categories: spine voxels and flesh voxels
+    Trajectories hold processed voxels as indices into their event's store. Voxels are broken into two categories: spine voxels and flesh voxels
     Spine voxels dictate the trajectory's direction. Flesh voxels have no effect on the trajectory-the trajectory is just used to store them.
-    When a new spine member is added, the trajectory's direction is updated.
-    Currently there is no weighting on the direction based on confidence.    
+    When a new spine member is added, the trajectory's direction is updated from running sums, so each update is constant time.
+    By default every spine step counts the same. weighting can also be 'adc', weighting each step by the signal of the voxel it
+    reaches, or 'recency', where older steps fade by a factor of decay for every newer step.
     """
-    def __init__(self, vox):
+    def __init__(self, ev, vox, weighting='uniform', decay=.9):
+        self.ev = ev
+        self.weighting = weighting
+        self.decay = decay
         self.du = 0.
         self.dv = 0.
         self.dw = 0.
-        self.directions = []
-        self.flesh = []
-        self.spine = [vox]
+        #running sums of the spine steps and their total weight
+        self.su = 0
+        self.sv = 0
+        self.sw = 0
+        self.weight = 0
+        self.flesh = IndexBuffer()
+        self.spine = IndexBuffer()
+        self.spine.append(vox)
+        self.members = IndexBuffer()
+        self.members.append(vox)
         self.tail = vox
     
     def addFlesh(self, vox):
         self.flesh.append(vox)
+        self.members.append(vox)
         
     def addSpine(self, vox):
         """
         Add a voxel to the Trajectory's spine. Direction is updated for every spine member added.
         """
+        self.addStep(self.ev.getDirection(self.tail, vox), vox)
         self.spine.append(vox)
+        self.members.append(vox)
         self.tail = vox
-        self.directions.append(getGradient(self.spine[-2], [self.spine[-1]])[self.spine[-1]][0])
-        self.du = sum([v[0] for v in self.directions]) / float(len(self.directions))
-        self.dv = sum([v[1] for v in self.directions]) / float(len(self.directions))
-        self.dw = sum([v[2] for v in self.directions]) / float(len(self.directions))
+    
+    def addStep(self, (du, dv, dw), vox):
+        """
+        Add one spine step, going to voxel vox, to the direction sums.
+        """
+        if self.weighting == 'recency':
+            self.su = self.su*self.decay + du
+            self.sv = self.sv*self.decay + dv
+            self.sw = self.sw*self.decay + dw
+            self.weight = self.weight*self.decay + 1
+        else:
+            if self.weighting == 'adc':
+                w = self.ev.getAdc(vox)
+            else:
+                w = 1
+            self.su += w*du
+            self.sv += w*dv
+            self.sw += w*dw
+            self.weight += w
+        self.updateDir()
+    
+    def updateDir(self):
+        if self.weight != 0:
+            self.du = self.su / float(self.weight)
+            self.dv = self.sv / float(self.weight)
+            self.dw = self.sw / float(self.weight)
     
     def merge(self, tra):
         """
-        Merge this trajectory with another trajectory. First, merge spines, then add all flesh members.
+        Merge this trajectory with another trajectory. The other spine is attached after this tail, then all flesh members are added.
+        The direction sums combine directly: this trajectory's, the step joining the two, then the other trajectory's.
+        The result is the same as adding the other spine one voxel at a time.
         """
-        for v in tra.getSpine():
-            self.addSpine(v)
-        for v in tra.getFlesh():
-            self.addFlesh(v)
+        head = tra.getHead()
+        self.addStep(self.ev.getDirection(self.tail, head), head)
+        if self.weighting == 'recency':
+            fade = self.decay ** (len(tra.spine) - 1)
+            self.su = self.su*fade + tra.su
+            self.sv = self.sv*fade + tra.sv
+            self.sw = self.sw*fade + tra.sw
+            self.weight = self.weight*fade + tra.weight
+        else:
+            self.su += tra.su
+            self.sv += tra.sv
+            self.sw += tra.sw
+            self.weight += tra.weight
+        self.updateDir()
+        
+        self.spine.extend(tra.getSpine())
+        self.flesh.extend(tra.getFlesh())
+        self.members.extend(tra.getMembers())
+        self.tail = tra.tail
+
+    def remap(self, ev, idx):
+        """
+        Move this trajectory from a sub-event to its parent event ev. idx maps the sub-event's voxel indices to the parent's.
+        """
+        self.ev = ev
+        self.spine.remap(idx)
+        self.flesh.remap(idx)
+        self.members.remap(idx)
+        self.tail = int(idx[self.tail])
 
     def getDir(self):
         return self.du,self.dv,self.dw
@@ -262,19 +898,16 @@ class Trajectory(object):
         return self.spine[0]
     
     def getFlesh(self):
-        return self.flesh
+        return self.flesh.view()
     
     def getSpine(self):
-        return self.spine
+        return self.spine.view()
     
     def getMembers(self):
         """
-        Returns all members, spine and flesh
+        Returns all members, spine and flesh, in the order they were added. This is a view, not a copy.
         """
-        all = []
-        all.extend(self.flesh)
-        all.extend(self.spine)
-        return all
+        return self.members.view()
     
     def checkDir(self, (vdu, vdv, vdw), dirthresh):
         """
@@ -313,243 +946,2212 @@ class Trajectory(object):
     def toString(self):
         s = "Trajectory \n"
         s += "Direction: " + str(self.du) + ", " + str(self.dv) + ", " + str(self.dw) + "\n"
-        s += "Head:" + self.spine[0].toString() + " ; Tail: " + self.spine[-1].toString() + "\n"
+        s += "Head:" + self.ev.getVoxel(self.spine[0]).toString() + " ; Tail: " + self.ev.getVoxel(self.spine[-1]).toString() + "\n"
         s += "Spine Length: " + str(len(self.spine)) + ", Body Count: " + str(len(self.flesh)) + "\n-----"
         return s
         
           
-def listNeighbors(li, vox):
+class EventStats(object):
+    """
+    Opt-in instrumentation for one event: wall clock seconds per pipeline stage, and counters bumped in the tracking hot paths.
+    An event only keeps counts while its stats attribute is set to one of these. Left at None, each hot path pays a single check.
+    parse is the event's parseTime (see timeParsing). plot is added by whoever plots the event, runMain times PlotRenderer.submit.
+    Counters:
+    neighborLookups, candidates: popNeighbors calls in makeTrajectories and the free neighbors they returned.
+    gradRejects, dirRejects: candidates failing the gradient test, and passing it but failing the direction test.
+    recycled: voxels put back for later seeds. seedPops, staleSeeds: seeds taken off the seed heap, and out of date entries skipped.
+    mergePasses, mergeComparisons: passes over the merge queue, and trajectory pairs tested for merging.
+    """
+    stageNames = ("parse", "graph", "make", "merge", "clean", "plot")
+    counterNames = ("neighborLookups", "candidates", "gradRejects", "dirRejects", "recycled", "seedPops", "staleSeeds",
+                    "mergePasses", "mergeComparisons")
+    
+    def __init__(self):
+        self.times = dict.fromkeys(self.stageNames, 0.)
+        self.counts = dict.fromkeys(self.counterNames, 0)
+        self.started = None
+    
+    def start(self):
+        self.started = time.time()
+    
+    def stop(self, stage):
         """
-        Neighboring voxels in 3D hexagonal geometry.
-        Finds all neighbors of an input voxel in an input list.
-        Since spatial coordinates are treated as Cartesian, some manipulation is necessary to get the proper hexagonal neighbors.
-        Each entry in nmap dictionary is a small adjustment of the given voxel's coordinates that represents one of the 20 neighbors in space and time.
-        Alternating rows have a slightly different set of neighbor mappings.
-        """
-        ne = []
-        q = vox.getID()
-        if q[1]%2 == 1:
-            nmap = {
-                (q[0], q[1], q[2]-1, q[3]), (q[0], q[1]-1, q[2], q[3]), (q[0], q[1]-1, q[2]+1, q[3]),
-                (q[0], q[1], q[2]+1, q[3]), (q[0], q[1]+1, q[2]+1, q[3]), (q[0], q[1]+1, q[2], q[3]),
-                
-                (q[0], q[1], q[2], q[3]-1), (q[0], q[1], q[2]-1, q[3]-1), (q[0], q[1]-1, q[2], q[3]-1),
-                (q[0], q[1]-1, q[2]+1, q[3]-1), (q[0], q[1], q[2]+1, q[3]-1), (q[0], q[1]+1, q[2]+1, q[3]-1),
-                (q[0], q[1]+1, q[2], q[3]-1),
-                
-                (q[0], q[1], q[2], q[3]+1), (q[0], q[1], q[2]-1, q[3]+1), (q[0], q[1]-1, q[2], q[3]+1),
-                (q[0], q[1]-1, q[2]+1, q[3]+1), (q[0], q[1], q[2]+1, q[3]+1), (q[0], q[1]+1, q[2]+1, q[3]+1),
-                (q[0], q[1]+1, q[2], q[3]+1)
-                }
-        else:
-            nmap = {
-                (q[0], q[1], q[2]-1, q[3]), (q[0], q[1]-1, q[2], q[3]), (q[0], q[1]-1, q[2]-1, q[3]),
-                (q[0], q[1], q[2]+1, q[3]), (q[0], q[1]+1, q[2]-1, q[3]), (q[0], q[1]+1, q[2], q[3]),
-                
-                (q[0], q[1], q[2], q[3]-1), (q[0], q[1], q[2]-1, q[3]-1), (q[0], q[1]-1, q[2], q[3]-1),
-                (q[0], q[1]-1, q[2]-1, q[3]-1), (q[0], q[1], q[2]+1, q[3]-1), (q[0], q[1]+1, q[2]-1, q[3]-1),
-                (q[0], q[1]+1, q[2], q[3]-1),
-                
-                (q[0], q[1], q[2], q[3]+1), (q[0], q[1], q[2]-1, q[3]+1), (q[0], q[1]-1, q[2], q[3]+1),
-                (q[0], q[1]-1, q[2]-1, q[3]+1), (q[0], q[1], q[2]+1, q[3]+1), (q[0], q[1]+1, q[2]-1, q[3]+1),
-                (q[0], q[1]+1, q[2], q[3]+1)
-                }
-        #Given data should not have any duplicate voxels. Could be disabled to improve runtime.
-        for v in li:
-            #Any neighbor will have one of the permutations of nmap
-            if v.getID() in nmap:
-                unique = True
-                for n in ne:
-                    if v.getID() == n.getID():
-                        unique = False
-                        print "**Error: Duplicate voxel**", v.getID()
-                if unique:        
-                    ne.append(v)    
-        return ne
+        Add the time since start to a stage.
+        """
+        self.times[stage] += time.time() - self.started
+        self.started = None
     
-def neighborCheck(avox, bvox):
+    def addCounts(self, other):
+        for name in self.counterNames:
+            self.counts[name] += other.counts[name]
+    
+    def record(self):
+        """
+        Plain dict of the times and counts, cheap to pass between processes and ready for json.
+        """
+        return {"times": dict(self.times), "counts": dict(self.counts)}
+
+
+class EventResult(object):
     """
-    Check if two voxels are neighbors of each other
+    One processed event and its counts, as returned by processEvents.
+    stats is None, or with instrumentation on a per event record for json, see processEvent.
     """
-    if len(listNeighbors([avox], bvox)) == 1:
-        return True
-    else: return False
     
-def voxDistance(avox, bvox):
+    def __init__(self, ev, startlen, nummerged, numpruned):
+        self.event = ev
+        self.id = ev.getID()
+        self.voxels = startlen
+        self.trajectories = len(ev.getTrajectories())
+        self.used = sum([len(t.getMembers()) for t in ev.getTrajectories()])
+        self.orphans = len(ev.getOrphans())
+        self.merged = nummerged
+        self.pruned = numpruned
+        self.stats = None
+    
+    def record(self):
+        """
+        The event's counts, and its stats if it has them, as one dict for json.
+        """
+        rec = {"event": self.id, "voxels": self.voxels, "trajectories": self.trajectories, "used": self.used,
+               "orphans": self.orphans, "merged": self.merged, "pruned": self.pruned}
+        if self.stats is not None:
+            rec.update(self.stats)
+        return rec
+
+
+class RunTotals(object):
     """
-    Find the distance between two voxels. Returns the absolute sum of any differences in their three coordinates. No weighting or fanciness.
+    Run-level totals, added up from EventResults.
     """
-    aID = avox.getID()
-    bID = bvox.getID()
     
-    if aID[0] != bID[0]:
-        return 1e10
-    return abs(aID[1] - bID[1]) + abs(aID[2] - bID[2]) + abs(aID[3] - bID[3])
+    def __init__(self, slowest=5):
+        self.events = 0
+        self.voxels = 0
+        self.trajectories = 0
+        self.orphans = 0
+        self.merged = 0
+        self.pruned = 0
+        #summed instrumentation from results that have it, and a heap of the slowest events by total time
+        self.instrumented = 0
+        self.times = dict.fromkeys(EventStats.stageNames, 0.)
+        self.counts = dict.fromkeys(EventStats.counterNames, 0)
+        self.numslowest = slowest
+        self.slowest = []
+    
+    def add(self, res):
+        self.events += 1
+        self.voxels += res.voxels
+        self.trajectories += res.trajectories
+        self.orphans += res.orphans
+        self.merged += res.merged
+        self.pruned += res.pruned
+        if res.stats is not None:
+            self.instrumented += 1
+            for name, t in res.stats["times"].items():
+                self.times[name] += t
+            for name, n in res.stats["counts"].items():
+                self.counts[name] += n
+            total = sum(res.stats["times"].values())
+            heapq.heappush(self.slowest, (total, res.id))
+            if len(self.slowest) > self.numslowest:
+                heapq.heappop(self.slowest)
+    
+    def toString(self):
+        s = "Total voxels: " + str(self.voxels) + "\n"
+        s += "Total trajectories: " + str(self.trajectories) + "\n"
+        s += "Total orphans: " + str(self.orphans)
+        return s
+    
+    def statsString(self):
+        """
+        Run summary of the instrumentation: merges and prunes, time per stage, the hot path counters and the slowest events.
+        """
+        s = "Instrumented events: " + str(self.instrumented) + "\n"
+        s += "Merged trajectories: " + str(self.merged) + "\n"
+        s += "Pruned trajectories: " + str(self.pruned) + "\n"
+        total = sum(self.times.values())
+        for name in EventStats.stageNames:
+            share = 100. * self.times[name] / total if total > 0 else 0.
+            s += "Time %s: %.3fs (%.1f%%)\n" % (name, self.times[name], share)
+        for name in EventStats.counterNames:
+            s += name + ": " + str(self.counts[name]) + "\n"
+        s += "Slowest events: " + ", ".join(["%s (%.3fs)" % (eid, t) for t, eid in sorted(self.slowest, reverse=True)])
+        return s
 
-def getGradient(vox, neigh):
+
+class BinaryEvents(object):
     """
-    Creates a gradient dictionary for an input voxel and a list of its neighbors. Non-neighbor gradient is untested.
-    Dictionary uses the neighbor voxel as keys with tuple values ((du,dv,dw), dE)
+    Read-only access to a binary event file made by convertToBinary. The file is memory-mapped, nothing is parsed.
+    Layout, all little-endian:
+    8 byte magic, then int64 event count, voxel count and byte position of the index.
+    One block per event of int32 voxel data, stored column by column (chamber, row, column, bucket, adc) so events can use it without copying.
+    The index, an (events, 2) int64 table of each event's offset (in voxels) and voxel count.
+    Any event can be looked up directly by its number.
     """
-    grad = dict()
-    for v in neigh:
-        dE = vox.getVal() - v.getVal()
-        du = vox.getID()[1] - v.getID()[1]
-        dv = vox.getID()[2] - v.getID()[2]
-        dw = vox.getID()[3] - v.getID()[3]
-        
-        grad[v] = (du,dv,dw), dE
-    return grad
+    
+    def __init__(self, filename):
+        self.mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        if self.mm[:8].tostring() != binaryMagic:
+            raise ValueError(filename + " is not a binary event file")
+        self.numevents, self.numvoxels, indexpos = self.mm[8:32].view('<i8')
+        self.index = self.mm[indexpos:indexpos + 16*self.numevents].view('<i8').reshape(-1, 2)
+    
+    def __len__(self):
+        return int(self.numevents)
+    
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.getEvent(n)
+    
+    def getVoxelData(self, n):
+        """
+        The (N, 5) voxel array of event n, a view into the mapped file.
+        """
+        off, count = self.index[n]
+        start = binaryHeaderSize + 20*off
+        return self.mm[start:start + 20*count].view('<i4').reshape(5, count).T
+    
+    def getEvent(self, n):
+        ev = Event(n)
+        ev.setData(self.getVoxelData(n))
+        return ev
 
-def voxelsToArray(li):
+
+#Bump whenever a change to the tracking code changes its results, so old entries in a ResultCache stop matching.
+trackingVersion = 2
+
+class ResultCache(object):
     """
-    Convert a list of voxels into a numpy array for plotting
+    On-disk cache of tracking results, shared by runs and by worker processes. Entries are keyed on a hash of the event's voxel data,
+    the thresholds and trackingVersion, so the same voxels with the same settings load the stored result instead of being tracked.
+    Each entry is an npz file holding the event's assignment (see Event.getAssignment) and its merge and prune counts.
+    Entries are written to a temporary file and renamed into place, so readers never see half an entry and concurrent writers
+    of the same key just replace each other with the same content.
+    Reading an entry touches its modification time, and when the cache grows past maxbytes the least recently used entries are
+    removed down to 90% of it. The size is checked after every tenth of maxbytes this process writes, under a lock file.
     """
-    le = len(li)
-    earr = [np.zeros(le), np.zeros(le), np.zeros(le), np.zeros(le), np.zeros(le)]
-    for i, v in enumerate(li):
-        earr[0][i] = v.getID()[0]
-        earr[1][i] = v.getID()[1]
-        earr[2][i] = v.getID()[2]
-        earr[3][i] = v.getID()[3]
-        earr[4][i] = v.getVal()
-    return earr
     
-def plotEvent(ev, eventnum, trajcount, usedcount, orphancount, orphansOn, filename):
+    def __init__(self, directory, maxbytes=256*2**20):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.written = 0
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+    
+    def key(self, ev, *params):
+        """
+        Hex digest of the voxel data (in store order, which the indices depend on), params and trackingVersion.
+        """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(ev.getData(), dtype='<i4').tostring())
+        h.update(repr((trackingVersion,) + tuple(params)))
+        return h.hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npz")
+    
+    def get(self, key):
+        """
+        Returns (assignment, nummerged, numpruned), or None if the key is not cached.
+        """
+        path = self.path(key)
+        try:
+            data = np.load(path)
+            try:
+                a = dict([(name, data[name]) for name in data.files])
+            finally:
+                data.close()
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError):
+            #missing, evicted meanwhile, or unreadable. Either way, track the event again.
+            self.misses += 1
+            return None
+        self.hits += 1
+        counts = a.pop("counts")
+        return a, int(counts[0]), int(counts[1])
+    
+    def put(self, key, assignment, nummerged, numpruned):
+        path = self.path(key)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        handle, temp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        out = os.fdopen(handle, "wb")
+        try:
+            np.savez(out, counts=np.array([nummerged, numpruned]), **assignment)
+            out.close()
+            os.rename(temp, path)
+        except:
+            out.close()
+            os.remove(temp)
+            raise
+        self.written += os.path.getsize(path)
+        if self.written > self.maxbytes / 10:
+            self.evict()
+    
+    def entries(self):
+        """
+        (modification time, size, path) of every entry.
+        """
+        found = []
+        for folder in os.listdir(self.directory):
+            folder = os.path.join(self.directory, folder)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if not name.endswith(".npz"):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, st.st_size, path))
+        return found
+    
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is under 90% of maxbytes. Returns the number removed.
+        """
+        self.written = 0
+        lock = open(os.path.join(self.directory, "lock"), "w")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            found = sorted(self.entries())
+            total = sum([size for mtime, size, path in found])
+            removed = 0
+            for mtime, size, path in found:
+                if total <= self.maxbytes * .9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                removed += 1
+            return removed
+        finally:
+            lock.close()
+
+
+class StageCache(object):
     """
-    Makes a 3D plot of an event. Different trajectories are color coded, with optional orphans in gray.
-    Stronger signal voxels have larger point blobs.
+    In-memory cache of pipeline stage outputs for TrackingPipeline. Entries are an assignment (see Event.getAssignment) and the
+    stage's counts, keyed on the event's digest, the stage and every parameter up to and including that stage.
+    Sizes are counted from the assignment arrays. Past maxbytes the least recently used entries are dropped.
     """
-
-    fig = plt.figure(1, figsize=(10,8))
-    ax = fig.add_subplot(1,1,1, projection = '3d')
     
-    #Hardcode colors of the first 8 trajectories. This should usually be enough
-    colors = ["red", "orange", "yellow", "green", "cyan", "blue", "purple", "pink"]
-    for i, t in enumerate(ev.getTrajectories()):
-        evda = voxelsToArray(t.getMembers())
-        #if there are too many trajectories, prevent errors by giving them brown color
-        if i > 7:
-            tcolor = 'brown'
-        else :
-            tcolor = colors[i]
-        
-        p = ax.scatter(evda[1], evda[2], evda[3], s=2*evda[4], linewidth=0, color=tcolor)
+    def __init__(self, maxbytes=64*2**20):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
     
-    #Orphans are optional, switched from input
-    if orphansOn:
-        evda = voxelsToArray(ev.getOrphans())
-        tcolor = 'gray'
-        p = ax.scatter(evda[1], evda[2], evda[3], s=2*evda[4], linewidth=0, color=tcolor)
+    def __len__(self):
+        return len(self.entries)
     
-    plt.xlim(10, 50)
-    plt.ylim(10, 50)
-    ax.set_zlim3d(10,50)
+    def get(self, key):
+        """
+        Returns (assignment, counts), or None if the key is not cached.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.entries[key] = entry
+        return entry[0], entry[1]
     
-    #The title holds all the pertinent run information. Soem of this could probably be derived from ev instead of forcefed. 
-    ti = "Event " + str(eventnum) + "\n\n" + "Trajectories: " + str(trajcount) + "\n" + "Used Voxels: " + str(usedcount) + "\n" + "Orphans: " + str(orphancount)
-    plt.title(ti, horizontalalignment='left', x=.1)
+    def put(self, key, assignment, counts):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[2]
+        size = sum([a.nbytes for a in assignment.values()])
+        self.entries[key] = (assignment, counts, size)
+        self.size += size
+        while self.size > self.maxbytes and self.entries:
+            self.size -= self.entries.popitem(last=False)[1][2]
+    
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
 
-    ax.set_xlabel('Row')
-    ax.set_ylabel("Column")
-    ax.set_zlabel('Bucket')
+class TrackingPipeline(object):
+    """
+    processEvent split into memoized stages: make (gradthresh, dirthresh, segmenting or windows), merge (mergethresh) and clean (prunethresh).
+    Each stage's output is kept in a StageCache, so running an event again with only later parameters changed starts from the
+    last stage whose parameters match, and running it again unchanged is a lookup. Events are never changed except for their
+    trajectories and orphans, which are replaced on every run. Parsing and graph building happen once per event anyway, and
+    PlotRenderer's digest file skips plots that did not change.
+    computed and reused count the stages run and the stages taken from the cache.
+    """
     
-    plt.savefig(filename)
-    plt.close()
+    stageNames = ("make", "merge", "clean")
     
-
-############################################
-#Start of procedural code
-#Setup and parse the data
-evlist = []
-evcounter = 0
-datain = open('niffte_data.txt', 'r')
-
-for i, line in enumerate (datain):
-    #New events are denoted by # blocks. If one is encountered, start a new event.
-    if line.startswith('#'):
-        evlist.append(Event(evcounter))
-        evcounter += 1
-    #Otherwise, keep adding voxel data to the current event.
-    else:
-        s = np.fromstring(line, sep=" ")
-        evlist[-1].addVoxel(s)
+    def __init__(self, cache=None):
+        if cache is None:
+            cache = StageCache()
+        self.cache = cache
+        self.computed = dict([(name, 0) for name in self.stageNames])
+        self.reused = dict([(name, 0) for name in self.stageNames])
+    
+    def run(self, ev, gradthresh, dirthresh, mergethresh, prunethresh, segment=False, mincomponent=2, window=None):
+        """
+        Same as processEvent, returns an EventResult.
+        """
+        #segmenting or windows only change the result when small components are dropped, as in processEvent
+        params = (gradthresh, dirthresh, mincomponent if segment or window else 2, mergethresh, prunethresh)
+        digest = ev.getDigest()
+        keys = [(digest, "make") + params[:3], (digest, "merge") + params[:4], (digest, "clean") + params]
+        
+        #start after the last stage already cached
+        done = 0
+        for k in (3, 2, 1):
+            hit = self.cache.get(keys[k-1])
+            if hit is not None:
+                assignment, counts = hit
+                ev.setAssignment(assignment)
+                done = k
+                break
+        for name in self.stageNames[:done]:
+            self.reused[name] += 1
         
-datain.close()
+        startlen = ev.numVoxels()
+        nummerged = numpruned = 0
+        if done == 3:
+            nummerged, numpruned = counts
+        if done == 2:
+            nummerged = counts
+        if done == 0:
+            ev.reset()
+            trackEvent(ev, gradthresh, dirthresh, segment, mincomponent, window)
+            self.computed["make"] += 1
+            self.cache.put(keys[0], ev.getAssignment(), None)
+        if done <= 1:
+            nummerged = ev.mergeTrajectories(mergethresh)
+            self.computed["merge"] += 1
+            self.cache.put(keys[1], ev.getAssignment(), nummerged)
+        if done <= 2:
+            numpruned = ev.cleanTrajectories(startlen * prunethresh)
+            self.computed["clean"] += 1
+            self.cache.put(keys[2], ev.getAssignment(), (nummerged, numpruned))
+        return EventResult(ev, startlen, nummerged, numpruned)
+    
+    def toString(self):
+        return " ".join(["%s %d run %d reused" % (name, self.computed[name], self.reused[name]) for name in self.stageNames])
 
-#######
-#Parameters to set
 
+#Results files start with resultsMagic, their index files with resultsIndexMagic. See ResultsWriter.
+resultsMagic = "NIFFRES1"
+resultsIndexMagic = "NIFFRIX1"
 
-gradthreshold = .75
-dirthreshold = 2.05
-mthresh = .75
+#Voxel roles in a results file
+roleOrphan = 0
+roleSpine = 1
+roleFlesh = 2
 
-prunethresh = .08
+def resultsBlockSize(nvox, ntraj):
+    """
+    Bytes taken by one event's block in a results file, see ResultsWriter.
+    """
+    size = 20*nvox + 8*nvox + nvox
+    size += -size % 8
+    return size + 24*ntraj + 16*ntraj
+
+class ResultsWriter(object):
+    """
+    Writes tracking results to a compact binary file that ResultsFile reads back one event at a time.
+    Layout, all little-endian. The results file is resultsMagic and then one block per event, each starting at a multiple of 8 bytes:
+    The voxels as int32 columns (chamber, row, column, bucket, adc).
+    Per voxel, int32 trajectory number within the event (-1 for orphans), int32 place along the spine (-1 off the spine),
+    int8 role (roleOrphan, roleSpine or roleFlesh), padded to 8 bytes.
+    Per trajectory, float64 columns du, dv, dw, then int32 columns head voxel, tail voxel, spine size, flesh size.
+    The index file, filename + ".idx", is resultsIndexMagic and a row of int64 (event, block offset, voxels, trajectories) per event.
+    Both are only ever appended to, and an event's index row is written after its block, so a file can be read while it is being written.
+    A new writer replaces the file, unless append is on, which adds to it instead. Either way an event number can only be in a file once,
+    adding it again raises ValueError. Parallel writers each write their own shard file, mergeResults puts them together.
+    """
+    
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        self.events = set()
+        if append and os.path.exists(filename) and os.path.exists(filename + ".idx"):
+            existing = ResultsFile(filename)
+            self.events = set(existing.getEventIDs())
+            rows = len(existing)
+            existing = None
+            #drop an index row cut off by a writer that stopped partway
+            index = open(filename + ".idx", 'r+b')
+            index.truncate(8 + 32*rows)
+            index.close()
+            self.out = open(filename, 'ab')
+            self.index = open(filename + ".idx", 'ab')
+            self.out.seek(0, os.SEEK_END)
+            self.index.seek(0, os.SEEK_END)
+        else:
+            self.out = open(filename, 'wb')
+            self.index = open(filename + ".idx", 'wb')
+            self.out.write(resultsMagic)
+            self.index.write(resultsIndexMagic)
+        self.out.flush()
+        self.index.flush()
+    
+    def addEvent(self, ev):
+        """
+        Append an event's trajectories and orphans.
+        """
+        if ev.getID() in self.events:
+            raise ValueError("Event " + str(ev.getID()) + " is already in " + self.filename)
+        self.events.add(ev.getID())
+        n = ev.numVoxels()
+        trajs = ev.getTrajectories()
+        traj = np.full(n, -1, dtype='<i4')
+        order = np.full(n, -1, dtype='<i4')
+        role = np.zeros(n, dtype='i1')
+        direction = np.zeros((3, len(trajs)), dtype='<f8')
+        ends = np.zeros((4, len(trajs)), dtype='<i4')
+        for k, t in enumerate(trajs):
+            spine = t.getSpine()
+            flesh = t.getFlesh()
+            traj[spine] = k
+            traj[flesh] = k
+            order[spine] = np.arange(len(spine))
+            role[spine] = roleSpine
+            role[flesh] = roleFlesh
+            direction[:, k] = t.getDir()
+            ends[:, k] = (t.getHead(), t.getTail(), len(spine), len(flesh))
+        
+        offset = self.out.tell()
+        self.out.write(np.ascontiguousarray(ev.getData().T, dtype='<i4').tostring())
+        self.out.write(traj.tostring())
+        self.out.write(order.tostring())
+        self.out.write(role.tostring())
+        self.out.write("\0" * (-(29*n) % 8))
+        self.out.write(direction.tostring())
+        self.out.write(ends.tostring())
+        self.out.flush()
+        self.index.write(np.array([ev.getID(), offset, n, len(trajs)], dtype='<i8').tostring())
+        self.index.flush()
+    
+    def add(self, res):
+        """
+        Append an EventResult.
+        """
+        self.addEvent(res.event)
+    
+    def close(self):
+        self.out.close()
+        self.index.close()
+
+
+class ResultsFile(object):
+    """
+    Read-only access to a results file made by ResultsWriter. The file is memory-mapped, so reading one event does not load the others.
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        if self.mm[:8].tostring() != resultsMagic:
+            raise ValueError(filename + " is not a results file")
+        raw = open(filename + ".idx", 'rb').read()
+        if raw[:8] != resultsIndexMagic:
+            raise ValueError(filename + ".idx is not a results index")
+        #a row cut off by a writer that is still going is left out
+        rows = (len(raw) - 8) // 32
+        self.index = np.frombuffer(raw[8:8 + 32*rows], dtype='<i8').reshape(-1, 4)
+        self.rows = dict([(int(eid), k) for k, eid in enumerate(self.index[:, 0])])
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def __iter__(self):
+        for eid in self.getEventIDs():
+            yield self.getEvent(eid)
+    
+    def getEventIDs(self):
+        return [int(eid) for eid in self.index[:, 0]]
+    
+    def getBlock(self, eventid):
+        """
+        The raw bytes of an event's block, for mergeResults.
+        """
+        eid, offset, n, ntraj = self.index[self.rows[eventid]]
+        return self.mm[offset:offset + resultsBlockSize(n, ntraj)]
+    
+    def getEvent(self, eventid):
+        """
+        One event's results as a dict of arrays, views into the mapped file:
+        voxels (N, 5), trajectory, order and role per voxel, direction (T, 3), head, tail, spine and flesh per trajectory.
+        Head and tail are voxel numbers, rows of voxels.
+        """
+        eid, offset, n, ntraj = self.index[self.rows[eventid]]
+        pos = offset
+        def take(dtype, count):
+            view = self.mm[pos:pos + np.dtype(dtype).itemsize*count].view(dtype)
+            return view, pos + np.dtype(dtype).itemsize*count
+        
+        voxels, pos = take('<i4', 5*n)
+        traj, pos = take('<i4', n)
+        order, pos = take('<i4', n)
+        role, pos = take('i1', n)
+        pos += -(29*n) % 8
+        direction, pos = take('<f8', 3*ntraj)
+        ends, pos = take('<i4', 4*ntraj)
+        ends = ends.reshape(4, ntraj)
+        return {"event": int(eid), "voxels": voxels.reshape(5, n).T, "trajectory": traj, "order": order, "role": role,
+                "direction": direction.reshape(3, ntraj).T, "head": ends[0], "tail": ends[1], "spine": ends[2], "flesh": ends[3]}
+    
+    def getSpine(self, eventid, k):
+        """
+        Voxel numbers of trajectory k's spine in an event, in order from head to tail.
+        """
+        res = self.getEvent(eventid)
+        members = np.flatnonzero((res["trajectory"] == k) & (res["role"] == roleSpine))
+        return members[np.argsort(res["order"][members])]
+
+def mergeResults(shards, filename):
+    """
+    Combine results files, like the shards written by parallel workers, into one file with its events in event order.
+    An event found in more than one shard is an error. Returns the number of events written.
+    """
+    files = [ResultsFile(shard) for shard in shards]
+    owner = {}
+    for f in files:
+        for eid in f.getEventIDs():
+            if eid in owner:
+                raise ValueError("Event " + str(eid) + " is in both " + owner[eid].filename + " and " + f.filename)
+            owner[eid] = f
+    
+    writer = ResultsWriter(filename)
+    for eid in sorted(owner):
+        f = owner[eid]
+        row = f.index[f.rows[eid]]
+        offset = writer.out.tell()
+        writer.out.write(f.getBlock(eid).tostring())
+        writer.index.write(np.array([eid, offset, row[2], row[3]], dtype='<i8').tostring())
+    writer.close()
+    return len(owner)
+
+
+#Hexagonal neighbor offsets as (row, column, bucket) adjustments to a voxel's id. The first 6 are in the same time bucket,
+#the next 7 are one bucket earlier and the last 7 are one bucket later.
+#Alternating rows have a slightly different set of neighbor mappings.
+oddRowOffsets = (
+    (0, -1, 0), (-1, 0, 0), (-1, 1, 0), (0, 1, 0), (1, 1, 0), (1, 0, 0),
+    (0, 0, -1), (0, -1, -1), (-1, 0, -1), (-1, 1, -1), (0, 1, -1), (1, 1, -1), (1, 0, -1),
+    (0, 0, 1), (0, -1, 1), (-1, 0, 1), (-1, 1, 1), (0, 1, 1), (1, 1, 1), (1, 0, 1)
+    )
+evenRowOffsets = (
+    (0, -1, 0), (-1, 0, 0), (-1, -1, 0), (0, 1, 0), (1, -1, 0), (1, 0, 0),
+    (0, 0, -1), (0, -1, -1), (-1, 0, -1), (-1, -1, -1), (0, 1, -1), (1, -1, -1), (1, 0, -1),
+    (0, 0, 1), (0, -1, 1), (-1, 0, 1), (-1, -1, 1), (0, 1, 1), (1, -1, 1), (1, 0, 1)
+    )
+
+def neighborIDs(q):
+    """
+    The ids of all 20 possible neighbors of voxel id q in space and time, whether or not they exist in the data.
+    """
+    if q[1]%2 == 1:
+        offsets = oddRowOffsets
+    else:
+        offsets = evenRowOffsets
+    return [(q[0], q[1]+dr, q[2]+dc, q[3]+db) for dr, dc, db in offsets]
 
-showOrphans = True
+def listNeighbors(li, vox):
+        """
+        Neighboring voxels in 3D hexagonal geometry.
+        Finds all neighbors of an input voxel in an input list.
+        Since spatial coordinates are treated as Cartesian, some manipulation is necessary to get the proper hexagonal neighbors.
+        neighborIDs applies the offset tables above to get the ids of the 20 neighbors in space and time.
+        This scans the whole list, events use their own index instead. Duplicate voxels are dealt with when data is read (see
+        validateVoxels), so the list is taken to have none.
+        """
+        nmap = set(neighborIDs(vox.getID()))
+        #Any neighbor will have one of the permutations of nmap
+        return [v for v in li if v.getID() in nmap]
+    
+def neighborCheck(avox, bvox):
+    """
+    Check if two voxels are neighbors of each other
+    """
+    return avox.getID() in neighborIDs(bvox.getID())
+    
+def voxDistance(avox, bvox):
+    """
+    Find the distance between two voxels. Returns the absolute sum of any differences in their three coordinates. No weighting or fanciness.
+    """
+    aID = avox.getID()
+    bID = bvox.getID()
+    
+    if aID[0] != bID[0]:
+        return 1e10
+    return abs(aID[1] - bID[1]) + abs(aID[2] - bID[2]) + abs(aID[3] - bID[3])
 
-#some useful events for testing
-#1 has good alternate high glitch
-#12 is a useful single track
-# 29 is a softball split
-#28 for testing directionality, it seems to start bottom right and go up
-#10 three way split
-#70 is a showdown
-#78 three way split
-#66 tracks bleed
+def getGradient(vox, neigh):
+    """
+    Creates a gradient dictionary for an input voxel and a list of its neighbors. Non-neighbor gradient is untested.
+    Dictionary uses the neighbor voxel as keys with tuple values ((du,dv,dw), dE)
+    """
+    grad = dict()
+    for v in neigh:
+        dE = vox.getVal() - v.getVal()
+        du = vox.getID()[1] - v.getID()[1]
+        dv = vox.getID()[2] - v.getID()[2]
+        dw = vox.getID()[3] - v.getID()[3]
+        
+        grad[v] = (du,dv,dw), dE
+    return grad
 
-#known good parameters: .75 2.05 .75
+def candidateKernel(delta, dE, adc, gradthresh, tdir, dirthresh):
+    """
+    Gradient and direction checks for a batch of candidate neighbors, in one numpy pass instead of a loop over the candidates.
+    delta is the (K, 3) array of (du, dv, dw) from the current voxel to each candidate, dE the adc differences, adc the current voxel's
+    signal and tdir the trajectory's direction. These come straight from the graph's edge attributes.
+    The checks are the same as getGradient followed by Trajectory.checkDir.
+    Returns the gradient and direction masks, and the position of the lowest gradient candidate passing both. That position is -1
+    if nothing passes.
+    """
+    gradok = dE <= adc * gradthresh
+    
+    if tdir[0] == 0 and tdir[1] == 0 and tdir[2] == 0:
+        dirok = np.ones(len(dE), dtype=bool)
+        ok = gradok
+    else:
+        err = np.square(tdir - delta).sum(axis=1)
+        dirok = err <= dirthresh
+        ok = gradok & dirok
+    
+    #lowest gradient among the passing candidates, first one on ties
+    masked = np.where(ok, dE, np.iinfo(dE.dtype).max)
+    best = masked.argmin()
+    if not ok[best]:
+        best = -1
+    return gradok, dirok, best
 
-#----------------
-#batch information
-totalvox = 0
-totaltraj = 0
-totalorphans = 0
+def loadGraph(filename):
+    """
+    Read back a VoxelGraph written by VoxelGraph.save.
+    """
+    f = np.load(filename)
+    return VoxelGraph(f['indptr'], f['indices'], f['offsets'], f['dE'], f['duplicates'])
 
-#plot every event, 100 in all
-for i, ev in enumerate(evlist):
+def voxelsToArray(ev, idx=None):
+    """
+    Get an event's voxels as column arrays (chamber, row, column, bucket, adc) for plotting.
+    With no index array these are views of the event's store, no copying. Otherwise the indexed voxels are gathered in one step.
+    """
+    d = ev.getData()
+    if idx is not None:
+        d = d[idx]
+    return [d[:, 0], d[:, 1], d[:, 2], d[:, 3], d[:, 4]]
+    
+def parseBlock(lines, problems=None):
+    """
+    Parse a block of voxel lines into an (N, 5) integer array, with one vectorized call when the block is clean.
+    Otherwise the block is parsed line by line. Values are read like the original parser did, so 5.0 or 5.5 is adc 5.
+    Lines that are not 5 numbers raise ValueError, unless given a problems list. Then they are left out and reported as
+    "malformed" problems (see validateVoxels).
+    """
+    text = "".join(lines)
+    rows = [words for words in [line.split() for line in text.splitlines()] if words]
+    arr = np.fromstring(text, dtype=int, sep=" ")
+    #fromstring stops quietly at the first value that is not an integer, which can still leave a multiple of 5 values.
+    #Its result only counts if every line has 5 fields, all of them were read, and the last one is a whole integer.
+    if len(arr) == 5*len(rows) and all([len(words) == 5 for words in rows]) and (not rows or rows[-1][-1].lstrip("+-").isdigit()):
+        return arr.reshape(-1, 5)
     
-    run = ev
+    parsed = []
+    malformed = []
+    for words in rows:
+        try:
+            if len(words) != 5:
+                raise ValueError
+            parsed.append([int(float(w)) for w in words])
+        except (ValueError, OverflowError):
+            line = " ".join(words)
+            malformed.append({"kind": "malformed", "line": line, "message": "Malformed voxel line " + repr(line)})
+    if malformed and problems is None:
+        raise ValueError(malformed[0]["message"])
+    if problems is not None:
+        problems.extend(malformed)
+    return np.array(parsed, dtype=int).reshape(-1, 5)
+
+#Allowed (lowest, highest) of each voxel column: chamber, row, column, bucket, adc. None leaves that side open.
+#The detector has chambers 0 and 1, but synthetic data can have more, so chambers are only limited when asked for (see parseBounds).
+voxelBounds = ((0, None), (0, None), (0, None), (0, None), (0, None))
+
+#What validateVoxels does with voxels that share an id
+duplicatePolicies = ("sum", "max", "reject")
+
+def parseBounds(text):
+    """
+    voxelBounds with the chambers limited, from the command line. Either first:last like 0:1 or a single chamber.
+    """
+    lo, sep, hi = text.partition(":")
+    if not sep:
+        hi = lo
+    return ((int(lo), int(hi)),) + voxelBounds[1:]
 
-    oldlen = len(run.getData())
-    #make the trajectories
-    run.makeTrajectories(gradthreshold, dirthreshold)
-    #merge trajectories
-    nummerged = run.mergeTrajectories(mthresh)
+def warnDropped(problems, eventid):
+    """
+    Tell stderr about voxels and events validateVoxels threw out, so they never go missing silently.
+    """
+    outside = len([prob for prob in problems if prob["kind"] == "range"])
+    if outside:
+        sys.stderr.write("Warning: event " + str(eventid) + ": " + str(outside) + " voxels out of range were dropped\n")
+    if [prob for prob in problems if prob["kind"] == "reject"]:
+        sys.stderr.write("Warning: event " + str(eventid) + " was rejected for duplicate voxels\n")
+
+def validateVoxels(data, policy="max", bounds=voxelBounds):
+    """
+    Check an event's (N, 5) voxel array once, when it is loaded, so tracking can take the data as clean.
+    Voxels with a column outside bounds are dropped. Voxels that share an id are combined into one, at the place of the first:
+    policy "sum" adds their adc, "max" keeps the strongest. "reject" throws out the whole event.
+    Returns (data, problems). data is None for a rejected event. problems is a list of dicts, each with a "kind" ("range",
+    "duplicate" or "reject"), the voxel involved and a readable "message".
+    """
+    if policy not in duplicatePolicies:
+        raise ValueError("Unknown duplicate policy " + str(policy))
+    problems = []
+    d = np.asarray(data).reshape(-1, 5)
+    
+    ok = np.ones(len(d), dtype=bool)
+    for col, (lo, hi) in enumerate(bounds):
+        if lo is not None:
+            ok &= d[:, col] >= lo
+        if hi is not None:
+            ok &= d[:, col] <= hi
+    for row in d[~ok].tolist():
+        problems.append({"kind": "range", "voxel": row, "message": "Voxel out of range " + str(tuple(row))})
+    d = d[ok]
+    
+    #group equal ids, the stable sort keeps the first in the file first
+    n = len(d)
+    order = np.lexsort((d[:, 3], d[:, 2], d[:, 1], d[:, 0]))
+    sd = d[order]
+    first = np.ones(n, dtype=bool)
+    first[1:] = np.any(sd[1:, :4] != sd[:-1, :4], axis=1)
+    starts = np.flatnonzero(first)
+    copies = np.diff(np.append(starts, n))
+    if n == 0 or copies.max() == 1:
+        return d, problems
+    
+    for k in np.flatnonzero(copies > 1):
+        vid = sd[starts[k], :4].tolist()
+        problems.append({"kind": "duplicate", "voxel": vid, "copies": int(copies[k]),
+                         "message": "Duplicate voxel " + str(tuple(vid)) + " x" + str(copies[k])})
+    if policy == "reject":
+        problems.append({"kind": "reject", "message": "Event rejected for duplicate voxels"})
+        return None, problems
+    if policy == "sum":
+        adc = np.add.reduceat(sd[:, 4], starts)
+    else:
+        adc = np.maximum.reduceat(sd[:, 4], starts)
+    keep = order[starts]
+    out = d[keep]
+    out[:, 4] = adc
+    return out[np.argsort(keep)], problems
+
+def readEvents(filename, policy="max", bounds=voxelBounds, diagnostics=None):
+    """
+    Generator that reads a data file and yields one Event at a time, so processing can start before the whole file is read.
+    See readEventStream for the format and the checks.
+    """
+    datain = open(filename, 'r')
+    try:
+        for ev in readEventStream(datain, policy, bounds, diagnostics):
+            yield ev
+    finally:
+        datain.close()
+
+def readEventStream(datain, policy="max", bounds=voxelBounds, diagnostics=None, live=False):
+    """
+    Generator that reads events from an open file, pipe or socket file and yields one Event at a time.
+    New events are denoted by # blocks. Every line up to the next header belongs to the event, whatever the header's Ndigits count says.
+    With live on, for pipes and sockets, an event with an Ndigits count is yielded as soon as that many lines are read, without waiting
+    for the next header, which may be a long time coming. Lines past the count are skipped then, with a warning on stderr.
+    A block that runs into the next header early (truncated data) is cut short there.
+    Lines are read with readline, which returns as soon as a line is there, so events coming down a pipe are not held up by buffering.
+    Every event is checked by validateVoxels with policy and bounds, rejected events are left out. Given a diagnostics list, every
+    problem found is appended to it, tagged with its event number. That includes "malformed" lines and "ndigits" counts that do not
+    match the rows actually there. Without a list, a malformed block raises ValueError.
+    """
+    pending = []
+    evcounter = 0
+    readline = datain.readline
+    
+    def nextLine():
+        if pending:
+            return pending.pop()
+        return readline()
+    
+    def report(problems, eventid):
+        if diagnostics is not None:
+            for prob in problems:
+                prob["event"] = eventid
+                diagnostics.append(prob)
+    
+    def reportExtra(extra):
+        if extra > 0 and evcounter > 0:
+            sys.stderr.write("Warning: event " + str(evcounter - 1) + ": " + str(extra) + " voxel lines past the Ndigits count were skipped\n")
+            report([{"kind": "ndigits", "extra": extra,
+                     "message": str(extra) + " voxel lines past the Ndigits count were skipped"}], evcounter - 1)
+    
+    line = nextLine()
+    extra = 0
+    while line:
+        #skip anything before the first header. After a counted block these are rows past the count.
+        if not line.startswith('#'):
+            if line.strip():
+                extra += 1
+            line = nextLine()
+            continue
+        reportExtra(extra)
+        extra = 0
+        
+        words = line.split()
+        block = []
+        ndigits = None
+        if "Ndigits" in words:
+            ndigits = int(words[words.index("Ndigits") + 1])
+        if ndigits is not None and live:
+            while len(block) < ndigits:
+                line = nextLine()
+                if not line:
+                    break
+                #a header inside the block means the count was wrong. Push everything from it on back.
+                cut = line.find("#")
+                if cut >= 0:
+                    pending.append(line[cut:])
+                    if cut > 0:
+                        block.append(line[:cut])
+                    break
+                block.append(line)
+            line = None
+        else:
+            line = nextLine()
+            while line and not line.startswith('#'):
+                block.append(line)
+                line = nextLine()
+        
+        problems = []
+        if diagnostics is None:
+            arr = parseBlock(block)
+        else:
+            arr = parseBlock(block, problems)
+        if ndigits is not None:
+            rows = len([l for l in block if l.strip()])
+            if rows != ndigits:
+                problems.append({"kind": "ndigits", "expected": ndigits, "found": rows,
+                                 "message": "Header says " + str(ndigits) + " voxels, found " + str(rows)})
+        arr, found = validateVoxels(arr, policy, bounds)
+        warnDropped(found, evcounter)
+        report(problems + found, evcounter)
+        if arr is not None:
+            ev = Event(evcounter)
+            ev.setData(arr)
+            yield ev
+        evcounter += 1
+        if line is None:
+            line = nextLine()
+    
+    reportExtra(extra)
+
+def splitComponents(labels):
+    """
+    Voxel indices of each component, from findComponents labels. Duplicates (-1) are left out.
+    """
+    srt = np.argsort(labels, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(labels[srt])) + 1
+    return [idx for idx in np.split(srt, bounds) if len(idx) > 0 and labels[idx[0]] >= 0]
+
+def trackComponent(data, gradthresh, dirthresh, weighting, decay, instrument=False):
+    """
+    Run makeTrajectories on one component's voxel data for Event.trackComponents. Returns the component's event and its trace.
+    With instrument on, the event comes back with its own EventStats.
+    """
+    sub = Event(0)
+    sub.setData(data)
+    if instrument:
+        sub.stats = EventStats()
+    sub.trace = []
+    sub.makeTrajectories(gradthresh, dirthresh, weighting, decay)
+    trace = [(seed, recycled) for seed, recycled in sub.trace]
+    sub.trace = None
+    return sub, trace
+
+def trackComponentArgs(args):
+    """
+    trackComponent with its arguments packed in a tuple, for the process pool.
+    """
+    return trackComponent(*args)
+
+def trackEvent(ev, gradthresh, dirthresh, segment=False, mincomponent=2, window=None):
+    """
+    The tracking stage of processEvent: makeTrajectories, Event.trackComponents with segment on,
+    or Event.trackWindowed given a window in buckets.
+    """
+    if window:
+        ev.trackWindowed(gradthresh, dirthresh, window, mincomponent=mincomponent)
+    elif segment:
+        ev.trackComponents(gradthresh, dirthresh, mincomponent=mincomponent)
+    else:
+        ev.makeTrajectories(gradthresh, dirthresh)
+
+def processEvent(ev, gradthresh, dirthresh, mergethresh, prunethresh, segment=False, mincomponent=2, instrument=False, cache=None, window=None):
+    """
+    Run one event through makeTrajectories, mergeTrajectories and cleanTrajectories. Returns an EventResult.
+    prunethresh is a fraction of the event's voxel count, same as in the main loop.
+    With segment on, tracking runs on each connected component separately, see Event.trackComponents.
+    Given a window, tracking walks the event in windows of that many buckets, see Event.trackWindowed.
+    With instrument on, every stage is timed and the hot path counters kept, and the result's stats holds the record (see EventStats).
+    Given a ResultCache, a cached result is loaded instead of tracking, and new results are stored in it.
+    """
+    if cache is not None:
+        #segmenting or windows only change the result when small components are dropped
+        key = cache.key(ev, gradthresh, dirthresh, mergethresh, prunethresh, mincomponent if segment or window else 2)
+        hit = cache.get(key)
+        if hit is not None:
+            assignment, nummerged, numpruned = hit
+            ev.setAssignment(assignment)
+            res = EventResult(ev, ev.numVoxels(), nummerged, numpruned)
+            if instrument:
+                res.stats = EventStats().record()
+                res.stats["times"]["parse"] = ev.parseTime
+                res.stats["cached"] = True
+            return res
+        res = processEvent(ev, gradthresh, dirthresh, mergethresh, prunethresh, segment, mincomponent, instrument, None, window)
+        cache.put(key, ev.getAssignment(), res.merged, res.pruned)
+        return res
+    if instrument:
+        return processEventInstrumented(ev, gradthresh, dirthresh, mergethresh, prunethresh, segment, mincomponent, window)
+    startlen = ev.numVoxels()
+    trackEvent(ev, gradthresh, dirthresh, segment, mincomponent, window)
+    nummerged = ev.mergeTrajectories(mergethresh)
     #prune out small trajectories as a percent of the original voxel count. More original voxels means more voxels have to be present to keep a trajectory.
-    numpruned = run.cleanTrajectories(oldlen * prunethresh)
-    alltraj = run.getTrajectories()
-    
-    #trajectory information
-    usedlen = 0
-    for t in alltraj:
-        #detailed trajectory information
-        #print t.toString()
-        usedlen += len(t.getMembers())
-
-    
-    #run information
-    print
-    print "Event", i
-    print
-    print "Trajectories:", len(alltraj)
-    #print "Merged trj:", nummerged
-    #print "Pruned trj:", numpruned
-    
-    print "Starting voxels:", oldlen
-    print "Used voxels:", usedlen
-    print "Orphan voxels:", len(run.getOrphans())
-    print
-    
-    totalvox += oldlen
-    totaltraj += len(alltraj)
-    totalorphans += len(run.getOrphans())
-
-    plotEvent(run, i, len(alltraj), usedlen, len(run.getOrphans()), True, str(i))
-    
-print    
-print "RUN INFORMATION"
-print "Total voxels:", totalvox
-print "Total trajectories:", totaltraj
-print "Total orphans:", totalorphans
\ No newline at end of file
+    numpruned = ev.cleanTrajectories(startlen * prunethresh)
+    return EventResult(ev, startlen, nummerged, numpruned)
+
+def processEventInstrumented(ev, gradthresh, dirthresh, mergethresh, prunethresh, segment=False, mincomponent=2, window=None):
+    """
+    processEvent with every stage timed. The graph is built as its own stage, and dropped again afterwards if the event had none.
+    """
+    startlen = ev.numVoxels()
+    stats = EventStats()
+    stats.times["parse"] = ev.parseTime
+    ev.stats = stats
+    temporary = ev.graph is None
+    stats.start()
+    ev.getGraph()
+    stats.stop("graph")
+    stats.start()
+    trackEvent(ev, gradthresh, dirthresh, segment, mincomponent, window)
+    stats.stop("make")
+    made = len(ev.getTrajectories())
+    stats.start()
+    nummerged = ev.mergeTrajectories(mergethresh)
+    stats.stop("merge")
+    stats.start()
+    numpruned = ev.cleanTrajectories(startlen * prunethresh)
+    stats.stop("clean")
+    if temporary:
+        ev.graph = None
+    ev.stats = None
+    
+    res = EventResult(ev, startlen, nummerged, numpruned)
+    res.stats = stats.record()
+    res.stats["made"] = made
+    return res
+
+#Each pool worker's ResultCache, see processEvents
+workerCache = None
+
+def initWorker(cache):
+    """
+    Pool initializer for processEvents. Every worker keeps one ResultCache for all of its events, so the bytes it writes add up
+    towards the next eviction. A copy sent along with each job would start counting from zero every time.
+    """
+    global workerCache
+    workerCache = cache
+
+def timeParsing(events):
+    """
+    Generator that passes events through, adding the time the source took to read and parse each one to its parseTime.
+    """
+    events = iter(events)
+    while True:
+        start = time.time()
+        try:
+            ev = next(events)
+        except StopIteration:
+            return
+        ev.parseTime += time.time() - start
+        yield ev
+
+def processEventArgs(args):
+    """
+    processEvent with its arguments packed in a tuple, for the process pool. The worker's own workerCache is used.
+    """
+    ev, gradthresh, dirthresh, mergethresh, prunethresh, segment, mincomponent, instrument, window = args
+    return processEvent(ev, gradthresh, dirthresh, mergethresh, prunethresh, segment, mincomponent, instrument, workerCache, window)
+
+def processEvents(events, gradthresh, dirthresh, mergethresh, prunethresh, numworkers=1, totals=None, chunksize=4, segment=False, mincomponent=2,
+                  instrument=False, cache=None, window=None):
+    """
+    Generator that runs processEvent over a batch of events and yields the EventResults in the original event order.
+    With numworkers above 1 the events are spread over a pool of worker processes, 0 or None uses every core.
+    Events are handed out chunksize at a time to keep the overhead of passing them between processes down.
+    If a RunTotals is given, every result is added to it. segment, mincomponent, instrument, cache and window are passed on to processEvent.
+    Every event is processed independently, so the output is the same for any number of workers.
+    Workers each count what they write to the cache on their own, so with a pool the cache is trimmed once more at the end.
+    """
+    if numworkers is None or numworkers == 0:
+        numworkers = multiprocessing.cpu_count()
+    
+    if numworkers == 1:
+        results = (processEvent(ev, gradthresh, dirthresh, mergethresh, prunethresh, segment, mincomponent, instrument, cache, window) for ev in events)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(numworkers, initWorker, (cache,))
+        jobs = ((ev, gradthresh, dirthresh, mergethresh, prunethresh, segment, mincomponent, instrument, window) for ev in events)
+        results = pool.imap(processEventArgs, jobs, chunksize)
+    
+    try:
+        for res in results:
+            if totals is not None:
+                totals.add(res)
+            yield res
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            if cache is not None:
+                cache.evict()
+
+def eventSummary(res):
+    """
+    Short json-ready summary of an EventResult for streaming: the counts, and every trajectory's size, end voxels and direction.
+    """
+    ev = res.event
+    d = ev.getData()
+    tracks = []
+    for t in ev.getTrajectories():
+        tracks.append({"voxels": len(t.getMembers()), "spine": len(t.getSpine()), "head": d[t.getHead(), :4].tolist(),
+                       "tail": d[t.getTail(), :4].tolist(), "direction": list(t.getDir())})
+    return {"event": int(res.id), "voxels": res.voxels, "trajectories": res.trajectories, "used": res.used, "orphans": res.orphans,
+            "merged": res.merged, "pruned": res.pruned, "tracks": tracks}
+
+def streamTask(args):
+    """
+    processEvent for the streaming pool, returning just the eventSummary so little has to come back from the worker.
+    Errors come back as a summary with an "error" instead of being raised, so one bad event does not stop the stream.
+    That includes a summary that could not be written out as json.
+    """
+    ev = args[0]
+    try:
+        summary = eventSummary(processEvent(*args))
+        json.dumps(summary)
+        return summary
+    except Exception as e:
+        return {"event": int(ev.getID()), "error": repr(e)}
+
+def latencySummary(latencies):
+    """
+    Count, mean and 50/90/99th percentile and largest latency in seconds.
+    """
+    if len(latencies) == 0:
+        return {"count": 0}
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {"count": len(latencies), "mean": float(np.mean(latencies)), "p50": float(p50), "p90": float(p90), "p99": float(p99),
+            "max": float(np.max(latencies))}
+
+def streamTrack(events, out, gradthresh, dirthresh, mergethresh, prunethresh, numworkers=1, maxinflight=8, segment=False, mincomponent=2):
+    """
+    Track events as they arrive and write each one's eventSummary to out as a line of json as soon as it is done. Returns every
+    event's latency, the seconds from the event being read to its summary being written.
+    events is any iterator, usually readEventStream or readEventFrames on a pipe or socket. A thread reads it into a queue of at most
+    maxinflight events. With workers busy, at most maxinflight more are being tracked. Past that the reader waits, so the pipe or
+    socket fills up and the sender is held back instead of memory growing.
+    numworkers works like processEvents: 1 tracks in this process, 0 uses every core. With a pool, summaries come out in the order
+    the events finish, which need not be the order they came in. A result the pool could not send back is written as an error summary.
+    A worker that dies takes its events with it, which raises RuntimeError instead of waiting for them forever.
+    """
+    if maxinflight < 1:
+        raise ValueError("At least 1 event has to be in flight, not " + str(maxinflight))
+    if numworkers is None or numworkers == 0:
+        numworkers = multiprocessing.cpu_count()
+    #start the pool before the reader thread, so the workers fork without it
+    pool = None
+    if numworkers > 1:
+        pool = multiprocessing.Pool(numworkers)
+    
+    queue = Queue.Queue(maxinflight)
+    def reader():
+        try:
+            for ev in events:
+                queue.put((ev, time.time()))
+        except Exception as e:
+            queue.put(e)
+        queue.put(None)
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    
+    latencies = []
+    lock = threading.Lock()
+    def emit(summary, arrived):
+        with lock:
+            latency = time.time() - arrived
+            summary["latency"] = latency
+            latencies.append(latency)
+            out.write(json.dumps(summary, sort_keys=True) + "\n")
+            out.flush()
+    
+    #events in the pool as (result, arrival time, event number), and errors from emit in the pool's callback thread
+    pending = []
+    failures = []
+    #Pool has no public list of its worker processes, so this reads CPython's private Pool._pool (the same in 2.7 and 3.x).
+    #The pool replaces a worker that dies, so keep the ones it started with: a dead one's exitcode stays set.
+    workers = list(getattr(pool, "_pool", [])) if pool is not None else []
+    
+    def settle(limit):
+        """
+        Wait until at most limit events are in the pool. Successful results were already written by done, when they became ready.
+        Nothing is called back for a failed one, so that is written here.
+        """
+        while True:
+            if failures:
+                raise failures[0]
+            for job in [job for job in pending if job[0].ready()]:
+                pending.remove(job)
+                result, arrived, eventid = job
+                if not result.successful():
+                    try:
+                        result.get()
+                    except Exception as e:
+                        emit({"event": eventid, "error": repr(e)}, arrived)
+            if len(pending) <= limit:
+                return
+            if [w for w in workers if w.exitcode is not None]:
+                raise RuntimeError("A stream worker died, " + str(len(pending)) + " events in the pool were lost")
+            time.sleep(.002)
+    
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            ev, arrived = item
+            args = (ev, gradthresh, dirthresh, mergethresh, prunethresh, segment, mincomponent)
+            if pool is None:
+                emit(streamTask(args), arrived)
+                continue
+            settle(maxinflight - 1)
+            def done(summary, arrived=arrived):
+                try:
+                    emit(summary, arrived)
+                except Exception as e:
+                    failures.append(e)
+            pending.append((pool.apply_async(streamTask, (args,), callback=done), arrived, int(ev.getID())))
+        if pool is not None:
+            settle(0)
+            pool.close()
+            pool.join()
+            pool = None
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return latencies
+
+#Events shared by the parameter sweep workers. Set before the pool starts, so forked workers get them without pickling.
+sweepEvents = None
+#Each worker's TrackingPipeline, see sweepParameters
+sweepPipeline = None
+
+def sweepTask(params):
+    """
+    Track every shared sweep event with one parameter combination. Returns a table row per event, see sweepParameters.
+    """
+    gradthresh, dirthresh, mergethresh, prunethresh = params
+    rows = []
+    for ev in sweepEvents:
+        res = sweepPipeline.run(ev, gradthresh, dirthresh, mergethresh, prunethresh)
+        rows.append((gradthresh, dirthresh, mergethresh, prunethresh, res.id, res.voxels, res.trajectories, res.used, res.orphans))
+    return rows
+
+def sweepParameters(events, gradthresholds, dirthresholds, mergethresholds, prunethresholds, numworkers=1, stagebytes=64*2**20):
+    """
+    Run every combination of the threshold lists over the events. Returns a table with a row per event and combination:
+    (gradthresh, dirthresh, mergethresh, prunethresh, event, voxels, trajectories, used, orphans)
+    Events are read and their graphs built once, up front. Each worker process gets a forked copy of them and tracks one whole combination
+    at a time. Rows are grouped by combination in grid order, whatever the number of workers.
+    Combinations go through a TrackingPipeline with a StageCache of stagebytes per worker. The grid varies prune, then merge
+    thresholds fastest, and workers get neighboring combinations, so most of them only rerun the merge and clean stages.
+    """
+    global sweepEvents, sweepPipeline
+    sweepEvents = list(events)
+    sweepPipeline = TrackingPipeline(StageCache(stagebytes))
+    for ev in sweepEvents:
+        ev.buildGraph()
+    combos = list(itertools.product(gradthresholds, dirthresholds, mergethresholds, prunethresholds))
+    
+    if numworkers is None or numworkers == 0:
+        numworkers = multiprocessing.cpu_count()
+    if numworkers == 1:
+        tables = map(sweepTask, combos)
+    else:
+        pool = multiprocessing.Pool(min(numworkers, len(combos)))
+        try:
+            tables = pool.map(sweepTask, combos)
+        finally:
+            pool.close()
+            pool.join()
+    
+    sweepEvents = None
+    sweepPipeline = None
+    return [row for table in tables for row in table]
+
+def writeSweepTable(rows, out):
+    """
+    Write sweepParameters rows to an open file, one whitespace separated row per line under a # header.
+    """
+    out.write("#gradthresh dirthresh mergethresh prunethresh event voxels trajectories used orphans\n")
+    for row in rows:
+        out.write(" ".join([str(x) for x in row]) + "\n")
+
+def parseGrid(text):
+    """
+    Parse a parameter grid from the command line. Either a comma separated list like .5,.75,1 or start:stop:count for evenly spaced values.
+    """
+    if ":" in text:
+        start, stop, count = text.split(":")
+        return list(np.linspace(float(start), float(stop), int(count)))
+    return [float(x) for x in text.split(",")]
+
+def positiveInt(text):
+    """
+    Command line type for counts that have to be at least 1.
+    """
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("has to be at least 1, not " + text)
+    return value
+
+def sweepMain(args):
+    """
+    Command line for parameter sweeps, python tracks_standalone.py sweep -h for the options.
+    """
+    parser = argparse.ArgumentParser(prog="tracks_standalone.py sweep", description="Run a grid of tracking parameters over every event.")
+    parser.add_argument("datafile", nargs="?", default="niffte_data.txt", help="text or .bin event file")
+    parser.add_argument("--grad", type=parseGrid, default=[.75], help="gradient thresholds, list a,b,c or range start:stop:count")
+    parser.add_argument("--dir", type=parseGrid, default=[2.05], help="direction thresholds")
+    parser.add_argument("--merge", type=parseGrid, default=[.75], help="merge thresholds")
+    parser.add_argument("--prune", type=parseGrid, default=[.08], help="prune thresholds, as a fraction of each event's voxels")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes, 0 for every core")
+    parser.add_argument("--out", default="-", help="output table file, - for stdout")
+    parser.add_argument("--stage-cache", type=int, default=64, help="MB of stage results each worker keeps, see TrackingPipeline")
+    opts = parser.parse_args(args)
+    
+    rows = sweepParameters(openEvents(opts.datafile), opts.grad, opts.dir, opts.merge, opts.prune, opts.workers, opts.stage_cache * 2**20)
+    if opts.out == "-":
+        writeSweepTable(rows, sys.stdout)
+    else:
+        out = open(opts.out, 'w')
+        writeSweepTable(rows, out)
+        out.close()
+
+#Binary event files start with this, followed by the rest of a 32 byte header. See BinaryEvents.
+binaryMagic = "NIFFTEV1"
+binaryHeaderSize = 32
+
+def convertToBinary(textfile, binfile):
+    """
+    Convert a text data file into the binary format read by BinaryEvents. Events are streamed, only one is in memory at a time.
+    Returns the number of events written.
+    """
+    index = []
+    numvoxels = 0
+    out = open(binfile, 'wb')
+    out.write(np.zeros(binaryHeaderSize, dtype=np.uint8).tostring())
+    for ev in readEvents(textfile):
+        np.ascontiguousarray(ev.getData().T, dtype='<i4').tofile(out)
+        index.append((numvoxels, ev.numVoxels()))
+        numvoxels += ev.numVoxels()
+    
+    #the index goes after the data, padded to 8 bytes
+    indexpos = binaryHeaderSize + 20*numvoxels
+    pad = -indexpos % 8
+    out.write(np.zeros(pad, dtype=np.uint8).tostring())
+    indexpos += pad
+    np.array(index, dtype='<i8').reshape(-1, 2).tofile(out)
+    
+    out.seek(0)
+    out.write(binaryMagic)
+    np.array([len(index), numvoxels, indexpos], dtype='<i8').tofile(out)
+    out.close()
+    return len(index)
+
+def checkBinaryFile(textfile, binfile):
+    """
+    Round trip check. Returns True if every event in the binary file matches the text file it was converted from.
+    """
+    binevents = BinaryEvents(binfile)
+    count = 0
+    for ev in readEvents(textfile):
+        if count >= len(binevents) or not np.array_equal(ev.getData(), binevents.getVoxelData(count)):
+            return False
+        count += 1
+    return count == len(binevents)
+
+def openEvents(filename, policy="max", diagnostics=None, bounds=voxelBounds):
+    """
+    Iterate over the events in a text or binary data file. Binary files must end in .bin
+    Text files are validated as they are read, see readEvents. Binary files were validated when they were converted.
+    """
+    if filename.endswith('.bin'):
+        return BinaryEvents(filename)
+    return readEvents(filename, policy, bounds, diagnostics)
+
+def hexStep(pos, direction, rng, jitter=.3):
+    """
+    The neighbor of pos (row, column, bucket) that best follows direction, using the same odd/even row offsets as neighborIDs.
+    jitter adds random wobble to the choice so tracks are not perfectly straight.
+    """
+    if pos[0]%2 == 1:
+        offsets = oddRowOffsets
+    else:
+        offsets = evenRowOffsets
+    offs = np.array(offsets, dtype=float)
+    score = offs.dot(direction) / np.sqrt((offs**2).sum(axis=1)) + rng.normal(0, jitter, len(offs))
+    dr, dc, db = offsets[int(np.argmax(score))]
+    return (pos[0]+dr, pos[1]+dc, pos[2]+db)
+
+def adcProfile(profile, length, peak):
+    """
+    Signal along a track of the given length. 'flat' is the same everywhere, 'bragg' rises to a peak at the end of the track like a
+    stopping fission fragment, 'falling' is the reverse.
+    """
+    t = np.linspace(0, 1, max(length, 1))
+    if profile == 'flat':
+        shape = np.ones_like(t)
+    elif profile == 'bragg':
+        shape = .3 + .7*t**3
+    elif profile == 'falling':
+        shape = 1 - .7*t
+    else:
+        raise ValueError("Unknown adc profile " + str(profile))
+    return peak * shape
+
+def generateEvent(eventid, numtracks=3, tracklength=(15, 40), noise=10, chambers=(0, 1), peak=(20, 60), profile='bragg',
+                  width=.15, direction=None, box=(10, 50), seed=None):
+    """
+    Make a synthetic event in the same format as the data files, for testing and benchmarks.
+    Each track starts at a random point in the box, in a random chamber from chambers, and walks through hex neighbors (see hexStep)
+    for a length drawn from the tracklength range, along direction (a row, column, bucket vector) or a random one.
+    The signal follows profile (see adcProfile) with a peak drawn from the peak range, with 15% random spread.
+    width is the chance that each neighbor of a track voxel also gets a weaker flesh voxel. noise isolated low voxels are scattered
+    over the box. Where voxels land on the same id, the strongest one is kept. Returns an Event.
+    """
+    if isinstance(seed, np.random.RandomState):
+        rng = seed
+    else:
+        rng = np.random.RandomState(seed)
+    lo, hi = box
+    voxels = {}
+    
+    def add(key, adc):
+        adc = max(int(round(adc)), 1)
+        if voxels.get(key, 0) < adc:
+            voxels[key] = adc
+    
+    for k in range(numtracks):
+        chamber = chambers[rng.randint(len(chambers))]
+        length = rng.randint(tracklength[0], tracklength[1] + 1)
+        if direction is None:
+            d = rng.normal(0, 1, 3)
+        else:
+            d = np.array(direction, dtype=float)
+        d /= np.sqrt((d**2).sum())
+        adcs = adcProfile(profile, length, rng.uniform(peak[0], peak[1])) * rng.normal(1, .15, length).clip(.5, 1.5)
+        pos = tuple(rng.randint(lo, hi + 1, 3))
+        for a in adcs:
+            if not all(lo <= x <= hi for x in pos):
+                break
+            add((chamber,) + pos, a)
+            weak = a * rng.uniform(.3, .7, 20)
+            for q, keep, w in zip(neighborIDs((chamber,) + pos), rng.uniform(size=20) < width, weak):
+                if keep:
+                    add(q, w)
+            pos = hexStep(pos, d, rng)
+    
+    for k in range(noise):
+        chamber = chambers[rng.randint(len(chambers))]
+        add((chamber,) + tuple(rng.randint(lo, hi + 1, 3)), rng.randint(1, 6))
+    
+    ev = Event(eventid)
+    keys = sorted(voxels)
+    ev.setData(np.array([key + (voxels[key],) for key in keys], dtype=np.int32).reshape(-1, 5))
+    return ev
+
+def generateSized(eventid, numvoxels, seed=None, **options):
+    """
+    A synthetic event of roughly numvoxels voxels. The box grows with the event so the voxel density stays close to the real data,
+    and tracks are added until the count is reached. Other options go to generateEvent.
+    """
+    rng = np.random.RandomState(seed)
+    span = max(40, int(round(4 * numvoxels ** (1/3.))))
+    options.setdefault('tracklength', (span // 3, span))
+    noise = options.pop('noise', numvoxels // 10)
+    parts = [generateEvent(eventid, 0, noise=noise, box=(10, 10 + span), seed=rng, **options).getData()]
+    count = len(parts[0])
+    while count < numvoxels:
+        part = generateEvent(eventid, 1, noise=0, box=(10, 10 + span), seed=rng, **options).getData()
+        parts.append(part)
+        count += len(part)
+    
+    #keep the strongest voxel of any repeated id
+    data = np.concatenate(parts)
+    order = np.lexsort((-data[:, 4], data[:, 3], data[:, 2], data[:, 1], data[:, 0]))
+    data = data[order]
+    first = np.ones(len(data), dtype=bool)
+    first[1:] = np.any(data[1:, :4] != data[:-1, :4], axis=1)
+    ev = Event(eventid)
+    ev.setData(data[first])
+    return ev
+
+def writeEvents(events, filename):
+    """
+    Write events to a text data file in the same format readEvents reads, with an Ndigits count in every header.
+    """
+    out = open(filename, 'w')
+    for ev in events:
+        writeEventText(out, ev)
+    out.close()
+
+def writeEventText(out, ev):
+    """
+    Write one event to an open file in the text data format.
+    """
+    out.write("#### Event " + str(ev.getID()) + " #### Ndigits " + str(ev.numVoxels()) + " ####\n")
+    np.savetxt(out, ev.getData(), fmt="%d")
+
+#Binary stream frames: a little-endian int32 event number and voxel count, then the voxels as int32 rows of 5
+frameHeader = np.dtype([("event", "<i4"), ("count", "<i4")])
+
+def writeEventFrame(out, ev):
+    """
+    Write one event to an open file as a binary stream frame, see readEventFrames.
+    """
+    out.write(np.array([(ev.getID(), ev.numVoxels())], dtype=frameHeader).tostring())
+    out.write(np.ascontiguousarray(ev.getData(), dtype='<i4').tostring())
+
+def readExactly(datain, size):
+    """
+    Read size bytes, or fewer only at the end of the stream.
+    """
+    chunks = []
+    while size > 0:
+        chunk = datain.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+def readEventFrames(datain, policy="max", bounds=voxelBounds, diagnostics=None):
+    """
+    Generator over the events in a binary frame stream (see writeEventFrame), yielding each as soon as its frame is complete.
+    Events are checked by validateVoxels like readEventStream does. A frame cut off by the end of the stream is reported as "truncated".
+    """
+    while True:
+        head = readExactly(datain, frameHeader.itemsize)
+        if len(head) == 0:
+            return
+        eventid, count = -1, 0
+        if len(head) == frameHeader.itemsize:
+            eventid, count = np.frombuffer(head, dtype=frameHeader)[0]
+            body = readExactly(datain, 20*count)
+        if len(head) < frameHeader.itemsize or len(body) < 20*count:
+            if diagnostics is not None:
+                diagnostics.append({"kind": "truncated", "event": int(eventid), "message": "Stream ended inside an event frame"})
+            return
+        arr, problems = validateVoxels(np.frombuffer(body, dtype='<i4').reshape(-1, 5).astype(int), policy, bounds)
+        warnDropped(problems, int(eventid))
+        if diagnostics is not None:
+            for prob in problems:
+                prob["event"] = int(eventid)
+                diagnostics.append(prob)
+        if arr is not None:
+            ev = Event(int(eventid))
+            ev.setData(arr)
+            yield ev
+
+def openStream(address, mode="r"):
+    """
+    Open a stream for streamTrack or replayEvents. Returns (file, list of things to close when done).
+    address is - for stdin or stdout, unix:PATH for a local socket, tcp:HOST:PORT for a network one, or else a file or FIFO path.
+    For reading, sockets listen and take one connection, the acquisition connects to them. For writing, they connect.
+    """
+    if address == "-":
+        if mode == "r":
+            return sys.stdin, []
+        return sys.stdout, []
+    if address.startswith("unix:") or address.startswith("tcp:"):
+        if address.startswith("unix:"):
+            family, target = socket.AF_UNIX, address[5:]
+        else:
+            host, port = address[4:].rsplit(":", 1)
+            family, target = socket.AF_INET, (host, int(port))
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if mode == "r":
+            if family == socket.AF_UNIX and os.path.exists(target):
+                os.remove(target)
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(target)
+            sock.listen(1)
+            conn, peer = sock.accept()
+            return conn.makefile("rb"), [conn, sock]
+        sock.connect(target)
+        return sock.makefile("wb"), [sock]
+    f = open(address, mode + "b")
+    return f, [f]
+
+def replayEvents(filename, out, rate=0, binary=False, policy="max"):
+    """
+    Stand-in for the acquisition: write the events of a data file to an open stream, one at a time, flushing after each.
+    rate is events per second, 0 sends them as fast as the reader takes them. Returns the number of events sent.
+    """
+    sent = 0
+    start = time.time()
+    for ev in openEvents(filename, policy):
+        if rate > 0:
+            wait = start + sent / float(rate) - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        if binary:
+            writeEventFrame(out, ev)
+        else:
+            writeEventText(out, ev)
+        out.flush()
+        sent += 1
+    return sent
+
+def plotJob(ev, eventnum, trajcount, usedcount, orphancount, orphansOn, filename):
+    """
+    Gather everything plotEvent draws into plain arrays, so the rendering can happen in another process.
+    Returns (filename, title, list of trajectory voxel arrays, orphan voxel array or None).
+    """
+    #The title holds all the pertinent run information. Soem of this could probably be derived from ev instead of forcefed. 
+    ti = "Event " + str(eventnum) + "\n\n" + "Trajectories: " + str(trajcount) + "\n" + "Used Voxels: " + str(usedcount) + "\n" + "Orphans: " + str(orphancount)
+    d = ev.getData()
+    trajs = [d[t.getMembers()] for t in ev.getTrajectories()]
+    orphans = d[ev.getOrphans()] if orphansOn else None
+    return filename, ti, trajs, orphans
+
+def plotDigest(job):
+    """
+    A digest of everything that goes into a plot, used to skip plots that would come out the same as last time.
+    """
+    filename, ti, trajs, orphans = job
+    h = hashlib.md5()
+    h.update(ti)
+    for arr in trajs + [orphans]:
+        if arr is None:
+            h.update("none")
+        else:
+            h.update(str(arr.shape))
+            h.update(np.ascontiguousarray(arr).tostring())
+    return h.hexdigest()
+
+#pyplot, imported on the first plot so runs without plots never load matplotlib. See importPyplot.
+plt = None
+
+def importPyplot(backend=None):
+    """
+    Import pyplot and the 3D axes the first time plotting needs them, and return pyplot. A backend like 'Agg' is set before the
+    import, or switched to if pyplot is already loaded.
+    """
+    global plt
+    if plt is None:
+        import matplotlib
+        if backend is not None:
+            matplotlib.use(backend)
+        import matplotlib.pyplot
+        from mpl_toolkits.mplot3d import Axes3D
+        plt = matplotlib.pyplot
+    elif backend is not None:
+        plt.switch_backend(backend)
+    return plt
+
+#Figure and axes reused from one plot to the next, one per process
+plotAxes = None
+
+def renderPlot(job):
+    """
+    Draw a job from plotJob and save it. Different trajectories are color coded, with optional orphans in gray.
+    Stronger signal voxels have larger point blobs.
+    """
+    global plotAxes
+    filename, ti, trajs, orphans = job
+    if plotAxes is None:
+        fig = importPyplot().figure(figsize=(10,8))
+        plotAxes = fig.add_subplot(1,1,1, projection = '3d')
+    ax = plotAxes
+    ax.cla()
+    
+    #Hardcode colors of the first 8 trajectories. This should usually be enough
+    colors = ["red", "orange", "yellow", "green", "cyan", "blue", "purple", "pink"]
+    for i, d in enumerate(trajs):
+        #if there are too many trajectories, prevent errors by giving them brown color
+        if i > 7:
+            tcolor = 'brown'
+        else :
+            tcolor = colors[i]
+        
+        p = ax.scatter(d[:, 1], d[:, 2], d[:, 3], s=2*d[:, 4], linewidth=0, color=tcolor)
+    
+    #Orphans are optional, switched from input
+    if orphans is not None:
+        p = ax.scatter(orphans[:, 1], orphans[:, 2], orphans[:, 3], s=2*orphans[:, 4], linewidth=0, color='gray')
+    
+    ax.set_xlim(10, 50)
+    ax.set_ylim(10, 50)
+    ax.set_zlim3d(10,50)
+    
+    ax.set_title(ti, horizontalalignment='left', x=.1)
+
+    ax.set_xlabel('Row')
+    ax.set_ylabel("Column")
+    ax.set_zlabel('Bucket')
+    
+    ax.figure.savefig(filename)
+    return filename
+
+def plotEvent(ev, eventnum, trajcount, usedcount, orphancount, orphansOn, filename):
+    """
+    Makes a 3D plot of an event, right away in this process. See renderPlot.
+    """
+    renderPlot(plotJob(ev, eventnum, trajcount, usedcount, orphancount, orphansOn, filename))
+
+def startPlotWorker():
+    """
+    Pool initializer for PlotRenderer. Plots are only ever saved to files, so workers (or this process, drawing inline) use the Agg backend.
+    """
+    importPyplot('Agg')
+
+class PlotRenderer(object):
+    """
+    Renders event plots off the tracking loop. submit gathers what is needed from an event and hands it to a pool of worker
+    processes, so tracking goes on while the plots are drawn. Each worker keeps one figure and reuses it.
+    numworkers 0 draws in this process instead, which is slower but needs no extra processes.
+    At most maxpending plots wait in the queue, after that submit waits for the oldest.
+    Given a digest file, plots whose content is unchanged since the run that wrote it are skipped, as long as the image is still there
+    with the size and modification time it had then. A deleted or changed image is drawn again.
+    """
+    def __init__(self, numworkers=1, orphansOn=True, digestfile=None, maxpending=32):
+        self.orphansOn = orphansOn
+        self.digestfile = digestfile
+        self.maxpending = maxpending
+        self.pending = collections.deque()
+        self.digests = {}
+        #size and modification time of each image when the digest file was written
+        self.stamps = {}
+        self.rendered = 0
+        self.skipped = 0
+        #seconds spent drawing, in whichever process drew
+        self.rendertime = 0.
+        if digestfile is not None and os.path.exists(digestfile):
+            for line in open(digestfile):
+                words = line.rstrip("\n").split(" ", 3)
+                if len(words) == 4:
+                    digest, size, mtime, filename = words
+                    self.digests[filename] = digest
+                    self.stamps[filename] = size + " " + mtime
+        self.pool = None
+        if numworkers != 0:
+            self.pool = multiprocessing.Pool(numworkers, startPlotWorker)
+        else:
+            startPlotWorker()
+    
+    def submit(self, ev, eventnum, trajcount, usedcount, orphancount, filename):
+        job = plotJob(ev, eventnum, trajcount, usedcount, orphancount, self.orphansOn, filename)
+        digest = plotDigest(job)
+        if self.digests.get(filename) == digest and self.stamps.get(filename) == self.imageStamp(filename):
+            self.skipped += 1
+            return
+        self.digests[filename] = digest
+        self.rendered += 1
+        if self.pool is None:
+            self.rendertime += timeStage(renderPlot, job)[0]
+            return
+        while len(self.pending) >= self.maxpending:
+            self.rendertime += self.pending.popleft().get()[0]
+        self.pending.append(self.pool.apply_async(timeStage, (renderPlot, job)))
+    
+    def imageName(self, filename):
+        """
+        The file savefig writes for filename, which adds .png when there is no extension.
+        """
+        if os.path.splitext(filename)[1] == "":
+            return filename + ".png"
+        return filename
+    
+    def imageStamp(self, filename):
+        """
+        Size and modification time of the image for filename, or None if there is no image.
+        """
+        try:
+            st = os.stat(self.imageName(filename))
+        except OSError:
+            return None
+        return str(st.st_size) + " " + repr(st.st_mtime)
+    
+    def close(self):
+        """
+        Wait for every submitted plot, then write the digest file.
+        """
+        while self.pending:
+            self.rendertime += self.pending.popleft().get()[0]
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.digestfile is not None:
+            out = open(self.digestfile, "w")
+            for filename in sorted(self.digests):
+                stamp = self.imageStamp(filename)
+                if stamp is not None:
+                    out.write(self.digests[filename] + " " + stamp + " " + filename + "\n")
+            out.close()
+    
+
+def timeStage(func, *args):
+    """
+    Run func(*args), returns (seconds taken, result).
+    """
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def benchmarkSize(numvoxels, gradthresh, dirthresh, mergethresh, prunethresh, repeat=1, seed=0, plotlimit=100000, prunecap=200):
+    """
+    Time every stage on a synthetic event of about numvoxels voxels (see generateSized). Returns a dict for the JSON report.
+    Each stage is run repeat times on a fresh copy of the event, the report has the best and every time in seconds, and the number of
+    trajectories after making, merging and cleaning.
+    Parsing times the text block through parseBlock and setData, graph is Event.buildGraph, plot is renderPlot with a temporary file.
+    Plotting is skipped (None) for events bigger than plotlimit.
+    A big synthetic event is many tracks of the size found in a real one, so pruning a fraction of all its voxels would throw every
+    track out. The prune threshold counts at most prunecap voxels instead, about a real event. None or 0 prunes on the whole event,
+    like processEvent. The report has the resulting cleanthresh.
+    """
+    if repeat < 1:
+        raise ValueError("repeat has to be at least 1, not " + str(repeat))
+    data = generateSized(0, numvoxels, seed).getData()
+    lines = [" ".join([str(x) for x in row]) + "\n" for row in data.tolist()]
+    stages = ["parse", "graph", "make", "merge", "clean", "plot"]
+    times = dict([(stage, []) for stage in stages])
+    for k in range(repeat):
+        ev = Event(0)
+        t, arr = timeStage(parseBlock, lines)
+        t2, none = timeStage(ev.setData, arr)
+        times["parse"].append(t + t2)
+        times["graph"].append(timeStage(ev.buildGraph)[0])
+        times["make"].append(timeStage(ev.makeTrajectories, gradthresh, dirthresh)[0])
+        made = len(ev.getTrajectories())
+        times["merge"].append(timeStage(ev.mergeTrajectories, mergethresh)[0])
+        merged = len(ev.getTrajectories())
+        cleanthresh = prunethresh * (min(ev.numVoxels(), prunecap) if prunecap else ev.numVoxels())
+        times["clean"].append(timeStage(ev.cleanTrajectories, cleanthresh)[0])
+        if ev.numVoxels() <= plotlimit:
+            handle, filename = tempfile.mkstemp(suffix=".png")
+            os.close(handle)
+            job = plotJob(ev, 0, len(ev.getTrajectories()), ev.numVoxels() - len(ev.getOrphans()), len(ev.getOrphans()), True, filename)
+            times["plot"].append(timeStage(renderPlot, job)[0])
+            os.remove(filename)
+    
+    result = {"voxels": ev.numVoxels(), "requested": numvoxels, "made": made, "merged": merged, "cleanthresh": cleanthresh,
+              "trajectories": len(ev.getTrajectories()), "orphans": len(ev.getOrphans())}
+    for stage in stages:
+        if times[stage]:
+            result[stage] = {"best": min(times[stage]), "runs": times[stage]}
+        else:
+            result[stage] = None
+    return result
+
+def benchmark(sizes, gradthresh=.75, dirthresh=2.05, mergethresh=.75, prunethresh=.08, repeat=1, seed=0, plotlimit=100000, log=None, prunecap=200):
+    """
+    Run benchmarkSize over a list of event sizes. Returns a report dict, ready for json, with the parameters, versions and a result per size.
+    Progress goes to log, an open file, if given.
+    """
+    results = []
+    for numvoxels in sizes:
+        if log is not None:
+            log.write("benchmarking %d voxels\n" % numvoxels)
+        results.append(benchmarkSize(numvoxels, gradthresh, dirthresh, mergethresh, prunethresh, repeat, seed, plotlimit, prunecap))
+    return {"parameters": {"gradthresh": gradthresh, "dirthresh": dirthresh, "mergethresh": mergethresh, "prunethresh": prunethresh,
+                           "repeat": repeat, "seed": seed, "plotlimit": plotlimit, "prunecap": prunecap},
+            "python": sys.version.split()[0], "numpy": np.__version__, "results": results}
+
+def benchMain(args):
+    """
+    Command line for the scaling benchmark, python tracks_standalone.py bench -h for the options.
+    """
+    parser = argparse.ArgumentParser(prog="tracks_standalone.py bench", description="Time every tracking stage on synthetic events of growing size.")
+    parser.add_argument("--sizes", default="100,1000,10000,100000,1000000", help="comma separated voxels per event")
+    parser.add_argument("--grad", type=float, default=.75, help="gradient threshold")
+    parser.add_argument("--dir", type=float, default=2.05, help="direction threshold")
+    parser.add_argument("--merge", type=float, default=.75, help="merge threshold")
+    parser.add_argument("--prune", type=float, default=.08, help="prune threshold, as a fraction of the event's voxels")
+    parser.add_argument("--prune-cap", type=int, default=200,
+                        help="count at most this many voxels for the prune threshold, so big events keep their tracks. 0 counts them all")
+    parser.add_argument("--repeat", type=positiveInt, default=1, help="runs per size, the best is reported")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic events")
+    parser.add_argument("--plotlimit", type=int, default=100000, help="largest event to time plotting for")
+    parser.add_argument("--out", default="-", help="JSON report file, - for stdout")
+    opts = parser.parse_args(args)
+    
+    sizes = [int(x) for x in opts.sizes.split(",")]
+    report = benchmark(sizes, opts.grad, opts.dir, opts.merge, opts.prune, opts.repeat, opts.seed, opts.plotlimit, sys.stderr, opts.prune_cap)
+    if opts.out == "-":
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        out = open(opts.out, 'w')
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.close()
+
+def generateMain(args):
+    """
+    Command line for writing synthetic event files, python tracks_standalone.py generate -h for the options.
+    """
+    parser = argparse.ArgumentParser(prog="tracks_standalone.py generate", description="Write synthetic events in the text data format.")
+    parser.add_argument("out", help="output data file")
+    parser.add_argument("--events", type=int, default=100, help="number of events")
+    parser.add_argument("--voxels", type=int, default=0, help="voxels per event, sets the tracks and box to match. 0 uses the options below")
+    parser.add_argument("--tracks", type=int, default=3, help="tracks per event")
+    parser.add_argument("--length", type=int, nargs=2, default=[15, 40], help="shortest and longest track, in steps")
+    parser.add_argument("--noise", type=int, default=10, help="noise voxels per event")
+    parser.add_argument("--chambers", default="0,1", help="comma separated chamber ids")
+    parser.add_argument("--peak", type=float, nargs=2, default=[20, 60], help="lowest and highest peak signal of a track")
+    parser.add_argument("--profile", default="bragg", choices=["bragg", "flat", "falling"], help="signal along each track")
+    parser.add_argument("--width", type=float, default=.15, help="chance of a flesh voxel next to each track voxel")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    opts = parser.parse_args(args)
+    
+    rng = np.random.RandomState(opts.seed)
+    chambers = tuple([int(x) for x in opts.chambers.split(",")])
+    options = dict(chambers=chambers, peak=tuple(opts.peak), profile=opts.profile, width=opts.width)
+    if opts.voxels > 0:
+        events = (generateSized(n, opts.voxels, rng.randint(2**31), **options) for n in range(opts.events))
+    else:
+        events = (generateEvent(n, opts.tracks, tuple(opts.length), opts.noise, seed=rng, **options) for n in range(opts.events))
+    writeEvents(events, opts.out)
+
+def convertMain(args):
+    """
+    Command line for converting text data files to binary, python tracks_standalone.py convert -h for the options.
+    """
+    parser = argparse.ArgumentParser(prog="tracks_standalone.py convert",
+                                     description="Convert a text data file to the binary format, which later runs read without parsing.")
+    parser.add_argument("datafile", help="text event file")
+    parser.add_argument("out", nargs="?", default=None, help="binary file to write, must end in .bin. Defaults to datafile with .bin")
+    parser.add_argument("--no-check", dest="check", action="store_false", help="skip reading both files back to compare them")
+    opts = parser.parse_args(args)
+    
+    out = opts.out
+    if out is None:
+        out = os.path.splitext(opts.datafile)[0] + ".bin"
+    if not out.endswith(".bin"):
+        parser.error("binary files have to end in .bin")
+    print convertToBinary(opts.datafile, out), "events written to", out
+    if opts.check:
+        if not checkBinaryFile(opts.datafile, out):
+            print "Round trip check failed,", out, "does not match", opts.datafile
+            sys.exit(1)
+        print "Round trip check passed"
+
+def runMain(args):
+    """
+    Command line for tracking a data file, python tracks_standalone.py -h for the options. With no options it runs niffte_data.txt
+    with the known good parameters and plots every event, 100 in all.
+    """
+    #some useful events for testing
+    #1 has good alternate high glitch
+    #12 is a useful single track
+    # 29 is a softball split
+    #28 for testing directionality, it seems to start bottom right and go up
+    #10 three way split
+    #70 is a showdown
+    #78 three way split
+    #66 tracks bleed
+    
+    #known good parameters: .75 2.05 .75
+    parser = argparse.ArgumentParser(prog="tracks_standalone.py", description="Find trajectories in every event of a data file and plot them.",
+                                     epilog="Other commands: sweep, generate, convert, bench, stream, replay and results, each with its own -h.")
+    parser.add_argument("datafile", nargs="?", default="niffte_data.txt",
+                        help="text or .bin event file. For repeated runs, convert once with the convert command and use the .bin file")
+    parser.add_argument("--grad", type=float, default=.75, help="gradient threshold")
+    parser.add_argument("--dir", type=float, default=2.05, help="direction threshold")
+    parser.add_argument("--merge", type=float, default=.75, help="merge threshold")
+    parser.add_argument("--prune", type=float, default=.08, help="prune threshold, as a fraction of each event's voxels")
+    parser.add_argument("--duplicates", default="max", choices=duplicatePolicies,
+                        help="voxels sharing an id are combined by adding (sum) or keeping the strongest (max), or the event is left out (reject)")
+    parser.add_argument("--diagnostics", default=None, help="write every data problem found to this file, a line of json each")
+    parser.add_argument("--chambers", dest="bounds", type=parseBounds, default=voxelBounds,
+                        help="only keep voxels in these chambers, first:last like 0:1. Any chamber by default")
+    parser.add_argument("--events", default=None, help="comma separated event numbers to run, like 12,28,70. Binary files jump straight to them")
+    parser.add_argument("--workers", type=int, default=1, help="tracking worker processes. 1 runs everything in this process, 0 uses every core")
+    parser.add_argument("--segment", action="store_true", help="track each connected cluster of voxels on its own")
+    parser.add_argument("--mincomponent", type=int, default=2,
+                        help="with --segment or --window, clusters smaller than this go straight to the orphans. 2 gives the same trajectories as not segmenting")
+    parser.add_argument("--window", type=positiveInt, default=None,
+                        help="track each event in windows of this many buckets, so only a window at a time is graphed. Same results as not windowing")
+    parser.add_argument("--no-plots", dest="plots", action="store_false", help="skip plotting, matplotlib is never imported")
+    parser.add_argument("--plot-dir", default="", help="directory for the plots")
+    parser.add_argument("--plot-workers", type=int, default=1, help="processes drawing plots next to the tracking. 0 draws them in the tracking loop")
+    parser.add_argument("--plot-digests", default=None,
+                        help="keep plot digests in this file, so plots and images unchanged since the last run are not drawn again. Off by default")
+    parser.add_argument("--no-orphans", dest="orphans", action="store_false", help="leave the orphans out of the plots")
+    parser.add_argument("--instrument", action="store_true",
+                        help="time every stage, parsing and plotting included, and count what the tracking hot paths do. Prints a summary at the end")
+    parser.add_argument("--stats-file", default=None, help="with --instrument, write a line of json per event to this file")
+    parser.add_argument("--cache-dir", default=None,
+                        help="keep tracking results in this directory, so rerunning the same data with the same parameters skips the tracking")
+    parser.add_argument("--results", default=None, help="write every event's trajectories and orphans to this results file, see ResultsWriter")
+    parser.add_argument("--append", action="store_true", help="add to an existing --results file instead of replacing it")
+    parser.add_argument("--cache-size", type=int, default=256*2**20, help="cache size in bytes, the least recently used results are dropped past it")
+    opts = parser.parse_args(args)
+    
+    #Setup the data. Events are read from the file one at a time as the loop below asks for them.
+    diagnostics = []
+    events = openEvents(opts.datafile, opts.duplicates, diagnostics, opts.bounds)
+    if opts.events is not None:
+        onlyEvents = [int(x) for x in opts.events.split(",")]
+        if isinstance(events, BinaryEvents):
+            binevents = events
+            events = timeParsing(binevents.getEvent(n) for n in onlyEvents)
+        else:
+            events = [ev for ev in timeParsing(events) if ev.getID() in onlyEvents]
+    else:
+        events = timeParsing(events)
+    
+    #batch information
+    totals = RunTotals()
+    renderer = None
+    if opts.plots:
+        if opts.plot_dir and not os.path.isdir(opts.plot_dir):
+            os.makedirs(opts.plot_dir)
+        renderer = PlotRenderer(opts.plot_workers, opts.orphans, opts.plot_digests or None)
+    cache = None
+    if opts.cache_dir is not None:
+        cache = ResultCache(opts.cache_dir, opts.cache_size)
+    statsout = None
+    if opts.instrument and opts.stats_file is not None:
+        statsout = open(opts.stats_file, 'w')
+    results = None
+    if opts.results is not None:
+        results = ResultsWriter(opts.results, opts.append)
+    firstevent = None
+    
+    for res in processEvents(events, opts.grad, opts.dir, opts.merge, opts.prune, opts.workers, segment=opts.segment,
+                             mincomponent=opts.mincomponent, instrument=opts.instrument, cache=cache, window=opts.window):
+        if firstevent is None:
+            firstevent = time.time() - importTime
+        
+        run = res.event
+        i = res.id
+        
+        #run information
+        print
+        print "Event", i
+        print
+        print "Trajectories:", res.trajectories
+        #print "Merged trj:", res.merged
+        #print "Pruned trj:", res.pruned
+        
+        print "Starting voxels:", res.voxels
+        print "Used voxels:", res.used
+        print "Orphan voxels:", res.orphans
+        print
+    
+        if renderer is not None:
+            start = time.time()
+            renderer.submit(run, i, res.trajectories, res.used, res.orphans, os.path.join(opts.plot_dir, str(i)))
+            if res.stats is not None:
+                res.stats["times"]["plot"] = time.time() - start
+        totals.add(res)
+        if statsout is not None:
+            statsout.write(json.dumps(res.record(), sort_keys=True) + "\n")
+        if results is not None:
+            results.add(res)
+    
+    if renderer is not None:
+        renderer.close()
+    if results is not None:
+        results.close()
+    print    
+    print "RUN INFORMATION"
+    print totals.toString()
+    if diagnostics:
+        print "Data problems:", len(diagnostics)
+        for prob in diagnostics:
+            print "**Error: Event " + str(prob["event"]) + ": " + prob["message"] + "**"
+    if opts.diagnostics is not None:
+        out = open(opts.diagnostics, 'w')
+        for prob in diagnostics:
+            out.write(json.dumps(prob, sort_keys=True) + "\n")
+        out.close()
+    if statsout is not None:
+        statsout.close()
+    if opts.instrument:
+        print totals.statsString()
+        if renderer is not None:
+            print "Plot rendering: %.3fs for %d plots, %d unchanged plots skipped" % (renderer.rendertime, renderer.rendered, renderer.skipped)
+        if firstevent is not None:
+            print "Time to first event: %.3fs" % firstevent
+
+def streamMain(args):
+    """
+    Command line for streaming, python tracks_standalone.py stream -h for the options.
+    """
+    parser = argparse.ArgumentParser(prog="tracks_standalone.py stream",
+                                     description="Track events as they arrive and print a line of json for each as soon as it is done.")
+    parser.add_argument("source", nargs="?", default="-", help="- for stdin, a file or FIFO, unix:PATH or tcp:HOST:PORT to listen on")
+    parser.add_argument("--binary", action="store_true", help="the stream is in binary frames instead of the text format")
+    parser.add_argument("--out", default="-", help="where the summaries go, - for stdout")
+    parser.add_argument("--grad", type=float, default=.75, help="gradient threshold")
+    parser.add_argument("--dir", type=float, default=2.05, help="direction threshold")
+    parser.add_argument("--merge", type=float, default=.75, help="merge threshold")
+    parser.add_argument("--prune", type=float, default=.08, help="prune threshold, as a fraction of each event's voxels")
+    parser.add_argument("--workers", type=int, default=1, help="tracking worker processes. 1 tracks in this process, 0 uses every core")
+    parser.add_argument("--inflight", type=positiveInt, default=8, help="most events waiting or being tracked before the reader holds back")
+    parser.add_argument("--duplicates", default="max", choices=duplicatePolicies, help="duplicate voxel policy, see validateVoxels")
+    parser.add_argument("--chambers", dest="bounds", type=parseBounds, default=voxelBounds, help="only keep voxels in these chambers, first:last")
+    parser.add_argument("--replay", default=None, help="instead of reading source, replay this data file into the stream, for testing")
+    parser.add_argument("--rate", type=float, default=0, help="with --replay, events per second. 0 sends as fast as they are taken")
+    opts = parser.parse_args(args)
+    
+    closers = []
+    if opts.replay is not None:
+        #the replay gets its own process, and this one lets go of the write end before any workers fork,
+        #so the reader sees the end of the stream once the replay is done
+        readfd, writefd = os.pipe()
+        sender = multiprocessing.Process(target=replayToFd, args=(opts.replay, writefd, opts.rate, opts.binary, opts.duplicates))
+        sender.daemon = True
+        sender.start()
+        os.close(writefd)
+        datain = os.fdopen(readfd, "rb")
+        closers.append(datain)
+    else:
+        datain, closers = openStream(opts.source, "r")
+    out, outclosers = openStream(opts.out, "w")
+    
+    diagnostics = []
+    if opts.binary:
+        events = readEventFrames(datain, opts.duplicates, opts.bounds, diagnostics)
+    else:
+        events = readEventStream(datain, opts.duplicates, opts.bounds, diagnostics, live=True)
+    try:
+        latencies = streamTrack(events, out, opts.grad, opts.dir, opts.merge, opts.prune, opts.workers, opts.inflight)
+    finally:
+        for c in closers + outclosers:
+            c.close()
+    
+    sys.stderr.write("latency " + json.dumps(latencySummary(latencies), sort_keys=True) + "\n")
+    for prob in diagnostics:
+        sys.stderr.write("**Error: Event " + str(prob["event"]) + ": " + prob["message"] + "**\n")
+
+def replayToFd(filename, fd, rate, binary, policy):
+    """
+    replayEvents into a file descriptor, closing it when done. For running the replay in its own process.
+    """
+    out = os.fdopen(fd, "wb")
+    try:
+        replayEvents(filename, out, rate, binary, policy)
+    finally:
+        out.close()
+
+def replayMain(args):
+    """
+    Command line for replaying a data file into a stream, python tracks_standalone.py replay -h for the options.
+    """
+    parser = argparse.ArgumentParser(prog="tracks_standalone.py replay", description="Send the events of a data file down a stream, like the acquisition would.")
+    parser.add_argument("datafile", help="text or .bin event file")
+    parser.add_argument("--to", default="-", help="- for stdout, a file or FIFO, unix:PATH or tcp:HOST:PORT to connect to")
+    parser.add_argument("--rate", type=float, default=0, help="events per second, 0 sends as fast as they are taken")
+    parser.add_argument("--binary", action="store_true", help="send binary frames instead of the text format")
+    opts = parser.parse_args(args)
+    
+    out, closers = openStream(opts.to, "w")
+    try:
+        replayEvents(opts.datafile, out, opts.rate, opts.binary)
+    finally:
+        for c in closers:
+            c.close()
+
+def resultsMain(args):
+    """
+    Command line for results files, python tracks_standalone.py results -h for the options.
+    """
+    parser = argparse.ArgumentParser(prog="tracks_standalone.py results", description="Look at or combine results files.")
+    sub = parser.add_subparsers(dest="action")
+    merge = sub.add_parser("merge", help="combine shards into one file")
+    merge.add_argument("out", help="combined results file")
+    merge.add_argument("shards", nargs="+", help="results files to combine")
+    show = sub.add_parser("show", help="print an event's trajectories, or a line per event")
+    show.add_argument("file", help="results file")
+    show.add_argument("event", type=int, nargs="?", default=None, help="event number")
+    opts = parser.parse_args(args)
+    
+    if opts.action == "merge":
+        print mergeResults(opts.shards, opts.out), "events"
+        return
+    f = ResultsFile(opts.file)
+    if opts.event is None:
+        for eid in f.getEventIDs():
+            res = f.getEvent(eid)
+            print "Event", eid, "voxels", len(res["voxels"]), "trajectories", len(res["head"]), "orphans", int((res["role"] == roleOrphan).sum())
+        return
+    res = f.getEvent(opts.event)
+    d = res["voxels"]
+    for k in range(len(res["head"])):
+        print "Trajectory", k, "spine", res["spine"][k], "flesh", res["flesh"][k], "head", tuple(d[res["head"][k], :4]),
+        print "tail", tuple(d[res["tail"][k], :4]), "direction", tuple(res["direction"][k])
+    print "Orphans", int((res["role"] == roleOrphan).sum())
+
+def main(argv=None):
+    """
+    Entry point. The first argument can pick another command, for example
+    python tracks_standalone.py sweep --grad .5:1:6 --dir 1,2.05,3 --workers 8 --out sweep.txt niffte_data.txt
+    python tracks_standalone.py generate --events 20 --voxels 5000 synthetic.txt
+    python tracks_standalone.py convert niffte_data.txt niffte_data.bin
+    python tracks_standalone.py bench --sizes 100,10000,1000000 --out bench.json
+    python tracks_standalone.py stream unix:/tmp/daq.sock --workers 4
+    python tracks_standalone.py replay niffte_data.txt --to unix:/tmp/daq.sock --rate 100
+    python tracks_standalone.py results merge all.nrs shard0.nrs shard1.nrs
+    Anything else is a tracking run, see runMain.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    commands = {"sweep": sweepMain, "generate": generateMain, "convert": convertMain, "bench": benchMain, "stream": streamMain, "replay": replayMain, "results": resultsMain,
+                "run": runMain}
+    if len(argv) > 0 and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
+    return runMain(argv)
+
+
+if __name__ == "__main__":
+    main()